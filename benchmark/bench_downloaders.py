@@ -0,0 +1,183 @@
+'''
+Benchmark the downloaders in this repo against a local mock CDN (mock_cdn.py), with configurable latency, error rate and sizes.
+
+All the HTTP traffic (requests and aiohttp) is redirected to the mock server, so it runs offline.
+For each downloader it reports the wall time, bytes written, throughput and request counts (per host, from the server),
+followed by util.metrics (time to first byte, retries...) and util.profiler spans.
+
+usage: python benchmark/bench_downloaders.py [--latency 0.02] [--error-rate 0.01] [--size 102400] [--only fantia,ameblo]
+'''
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import util
+from mock_cdn import MockCDN
+
+
+def redirect_to(cdn):
+    '''Send all requests (requests and aiohttp) to the mock server. Returns a function to undo it.'''
+    from requests.adapters import HTTPAdapter
+    import aiohttp
+
+    original_send = HTTPAdapter.send
+    original_request = aiohttp.ClientSession._request
+
+    def send(self, request, **kwargs):
+        # a copy, so the callers (e.g. util's metrics) still see the real URL.
+        url = request.url
+        request = request.copy()
+        request.url = cdn.rewrite(url)
+        r = original_send(self, request, **kwargs)
+        r.url = url
+        return r
+
+    async def _request(self, method, str_or_url, **kwargs):
+        return await original_request(self, method, cdn.rewrite(str(str_or_url)), **kwargs)
+
+    HTTPAdapter.send = send
+    aiohttp.ClientSession._request = _request
+
+    def undo():
+        HTTPAdapter.send = original_send
+        aiohttp.ClientSession._request = original_request
+    return undo
+
+# ---------- scenarios: each runs one downloader in the current (temp) folder ----------
+def bench_instalive(cdn):
+    from instalive import InstaliveDownloader
+
+    downloader = InstaliveDownloader('https://instagram.fbcdn.net/dash/live/bench.mpd', save_path='instalive', quality='highest')
+    downloader.download_init()
+    downloader.download_video(audio=True)
+
+def bench_instalive_live(cdn):
+    from instalive import InstaliveDownloader
+
+    # the stream starts now, and ends after all the segments are published.
+    cdn.live_speed = LIVE_SPEED
+    cdn._start_time = time.monotonic()
+    try:
+        downloader = InstaliveDownloader('https://instagram.fbcdn.net/dash/live/bench.mpd', save_path='instalive', quality='highest')
+        downloader.download_init()
+        downloader.download_live()
+    finally:
+        cdn.live_speed = 0
+
+def bench_fantia(cdn):
+    from scraper_fantia import FantiaDownloader
+
+    FantiaDownloader(key='bench', fanclub=1, output='fantia').download_all()
+
+def bench_ameblo(cdn):
+    from scraper_ameblo_api import download_all
+
+    download_all('bench', save_folder='ameblo', limit=20)
+
+def bench_radiko(cdn):
+    import scraper_radiko
+
+    # only benchmark the downloading; don't remux the segments with ffmpeg.
+    scraper_radiko.run = lambda *args, **kwargs: None
+    scraper_radiko.RadikoExtractor('https://radiko.jp/#!/ts/QRR/20240101100000', save_dir='radiko').parse()
+
+def bench_nico(cdn):
+    from nico import NicoDownloader
+
+    message_server_info = {'data': {'viewUri': 'https://mpn.live.nicovideo.jp/api/view/v4/bench', 'vposBaseTime': '2024-01-01T00:00:00+09:00'}}
+    NicoDownloader('user_session_bench', proxy='none', save_dir='nico').download_comments_native(message_server_info, Path('nico/comments.json'))
+
+LIVE_SPEED = 10
+
+SCENARIOS = {
+    'instalive': bench_instalive,
+    'instalive_live': bench_instalive_live,
+    'fantia': bench_fantia,
+    'ameblo': bench_ameblo,
+    'radiko': bench_radiko,
+    'nico': bench_nico,
+}
+
+def folder_size(folder):
+    files = [f for f in util.iter_files(folder, recursive=True)]
+    return len(files), sum(f.stat().st_size for f in files)
+
+def run(name, cdn, quiet=True):
+    cdn.reset_stats()
+    util.metrics.reset()
+    util.profiler.reset()
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix=f'bench_{name}_') as tmp:
+        os.chdir(tmp)
+        stdout = sys.stdout
+        error = None
+        t = time.perf_counter()
+        try:
+            if quiet:
+                sys.stdout = open(os.devnull, 'w', encoding='utf-8')
+            with util.profiler.span(name):
+                SCENARIOS[name](cdn)
+        except ImportError as e:
+            error = f'skipped (missing dependency: {e.name})'
+        except Exception as e:
+            error = f'failed: {e!r}'
+        finally:
+            if quiet:
+                sys.stdout.close()
+                sys.stdout = stdout
+            seconds = time.perf_counter() - t
+            os.chdir(cwd)
+        count, size = folder_size(tmp)
+
+    print(f'\n===== {name} =====')
+    if error:
+        print(error)
+        return None
+    requests = sum(s['requests'] for s in cdn.stats.values())
+    print(f'{seconds:.2f}s, {count} files, {size / 1024 / 1024:.1f} MB, {util.format_speed(size, seconds)}, {requests} requests ({requests / seconds:.0f}/s)')
+    print(f'{"host":<30} {"reqs":>7} {"304":>6} {"404":>6} {"503":>5} {"MB":>9}')
+    for host, s in sorted(cdn.stats.items()):
+        print(f'{host:<30} {s["requests"]:>7} {s["not_modified"]:>6} {s["not_found"]:>6} {s["errors_injected"]:>5} {s["bytes"] / 1024 / 1024:>9.1f}')
+    print()
+    util.metrics.report()
+    print()
+    util.profiler.report(top=0)
+    return {'seconds': seconds, 'files': count, 'bytes': size, 'requests': requests}
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds before each response (default: 0.01)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='probability of HTTP 503 for media requests (default: 0)')
+    parser.add_argument('--size', type=int, default=100*1024, help='size of images/segments in bytes (default: 102400)')
+    parser.add_argument('--file-size', type=int, default=20*1024*1024, help='size of Fantia post files in bytes (default: 20MB)')
+    parser.add_argument('--posts', type=int, default=30, help='number of Fantia posts / Ameblo entries / Nico comment segments (default: 30)')
+    parser.add_argument('--photos', type=int, default=4, help='photos per post/entry (default: 4)')
+    parser.add_argument('--segments', type=int, default=200, help='number of Instagram/Radiko segments (default: 200)')
+    parser.add_argument('--missing', type=float, default=0.02, help='fraction of Instagram segments that are missing, i.e. gaps to search across (default: 0.02)')
+    parser.add_argument('--live-speed', type=float, default=10, help='how many times faster than real time the live stream of instalive_live is (default: 10)')
+    parser.add_argument('--only', help=f'comma-separated scenarios to run (default: all of {",".join(SCENARIOS)})')
+    parser.add_argument('--verbose', '-v', action='store_true', help='show the output of the downloaders')
+    args = parser.parse_args()
+
+    global LIVE_SPEED
+    LIVE_SPEED = args.live_speed
+    names = args.only.split(',') if args.only else list(SCENARIOS)
+    with MockCDN(latency=args.latency, error_rate=args.error_rate, size=args.size, file_size=args.file_size,
+                 posts=args.posts, photos=args.photos, segments=args.segments, missing=args.missing) as cdn:
+        undo = redirect_to(cdn)
+        try:
+            results = {name: run(name, cdn, quiet=not args.verbose) for name in names}
+        finally:
+            undo()
+
+    print('\n===== summary =====')
+    for name, r in results.items():
+        print(f'{name:<10} ' + (f'{r["seconds"]:>8.2f}s {r["requests"]:>7} reqs {util.format_speed(r["bytes"], r["seconds"]):>12}' if r else 'n/a'))
+
+if __name__ == '__main__':
+    main()
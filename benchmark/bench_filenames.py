@@ -0,0 +1,68 @@
+'''
+Benchmark util.classify_filenames() against plain per-file re.match with the three patterns.
+
+usage: python benchmark/bench_filenames.py [-n COUNT]
+'''
+import random
+import string
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from util import TWITTER_FILENAME_RE, TWITTER_FILENAME_RELEXED_RE, INSTAGRAM_FILENAME_RE, classify_filenames, parse_filename
+
+
+def rand_str(rng, n, chars=string.ascii_letters + string.digits + '_'):
+    return ''.join(rng.choices(chars, k=n))
+
+def make_corpus(n, seed=0):
+    rng = random.Random(seed)
+    names = []
+    for i in range(n):
+        kind = rng.random()
+        twitter_core = f'{rand_str(rng, rng.randint(4, 15))}-{rng.randint(10**17, 10**19)}-2024{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}_{rng.randint(0, 235959):06d}-{rng.choice(["img", "vid", "gif"])}{rng.randint(1, 4)}'
+        if kind < 0.35: # strict Twitter
+            names.append(f'{twitter_core}{rng.choice(["", " (2)"])}{rng.choice([".jpg", ".png", ".mp4"])}')
+        elif kind < 0.45: # relaxed Twitter
+            names.append(f'[{rand_str(rng, 8)}] {twitter_core} {rand_str(rng, rng.randint(5, 40))}.jpg')
+        elif kind < 0.75: # Instagram
+            post = rng.choice([rand_str(rng, 11, string.ascii_letters + string.digits), f'STORY_{rng.randint(10**18, 10**19)}'])
+            names.append(f'24{rng.randint(1, 12):02d}{rng.randint(1, 28):02d}_{rand_str(rng, rng.randint(4, 20))}_{post}{rng.choice(["", "_2"])}.jpg')
+        else: # other (long) names, with lots of hyphens and underscores to make the relaxed pattern backtrack
+            names.append('-'.join(rand_str(rng, rng.randint(3, 12)) for _ in range(rng.randint(5, 20))) + rng.choice(['.jpg', '.txt', '.mp4']))
+    return names
+
+def baseline(names):
+    results = []
+    for name in names:
+        m = TWITTER_FILENAME_RE.match(name) or INSTAGRAM_FILENAME_RE.match(name) or TWITTER_FILENAME_RELEXED_RE.match(name)
+        results.append(m)
+    return results
+
+def timeit(func, names, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        parse_filename.cache_clear()
+        t = time.perf_counter()
+        result = func(names)
+        best = min(best, time.perf_counter() - t)
+    return best, result
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', type=int, default=200000, help='number of synthetic filenames (default: 200000)')
+    args = parser.parse_args()
+
+    names = make_corpus(args.n)
+    t_base, matches = timeit(baseline, names)
+    t_new, records = timeit(classify_filenames, names)
+    # both have to agree on what matches
+    assert [m is None for m in matches] == [r is None for r in records]
+    print(f'{len(names)} names, {sum(r is not None for r in records)} matched')
+    print(f'per-file re.match:    {t_base:.3f}s ({len(names) / t_base:,.0f} names/s)')
+    print(f'classify_filenames(): {t_new:.3f}s ({len(names) / t_new:,.0f} names/s), {t_base / t_new:.2f}x')
+
+if __name__ == '__main__':
+    main()
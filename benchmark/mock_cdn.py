@@ -0,0 +1,360 @@
+'''
+A local mock of the endpoints the downloaders in this repo talk to, for offline benchmarks (see bench_downloaders.py).
+
+Requests are routed by the original host, which is kept as the first path component:
+https://fantia.jp/api/v1/posts/1 is served as http://127.0.0.1:{port}/fantia.jp/api/v1/posts/1 (see MockCDN.rewrite()).
+
+Mocked:
+  * Instagram live DASH: MPD, init and media segments (instagram.fbcdn.net)
+  * Fantia: top page (csrf-token), fanclub/post APIs, post list pages, photos (cc.fantia.jp) and post files (Range supported)
+  * Ameblo: blog top page (INIT_DATA), blogEntries API, images API (blogimgapi.ameba.jp) and images (stat.ameba.jp)
+  * Radiko: program list XML, auth1/auth2, playlist and chunklist m3u8, aac segments (media.radiko.jp)
+  * Nico: NDGR view API (length-delimited ChunkedEntry) and backward PackedSegments (mpn.live.nicovideo.jp)
+'''
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients closing connections early (cancelled probes etc.) are normal here.
+        if not isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            super().handle_error(request, client_address)
+
+
+class MockCDN:
+    """
+    Args:
+        latency (float): Seconds to wait before answering each request.
+        error_rate (float): Probability of answering a media request (image/segment/file) with HTTP 503.
+        size (int): Size in bytes of images, segments and aac chunks.
+        file_size (int): Size in bytes of Fantia post files (big enough for ranged downloads by default).
+        posts (int): Number of Fantia posts (and Ameblo entries).
+        photos (int): Photos per Fantia post / images per Ameblo entry.
+        segments (int): Number of Instagram live segments (and Radiko aac chunks).
+        live_speed (float): If set, the Instagram stream is live: it starts with 5 segments and publishes new ones
+            live_speed times faster than real time (segments are 2s), with a dynamic MPD until all are published.
+        missing (float): Fraction of Instagram segments that are skipped (never available), leaving gaps in the timeline.
+        seed (int): Seed for the generated data.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, size=100*1024, file_size=20*1024*1024, posts=30, photos=4, segments=200, live_speed=0, missing=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.size = size
+        self.file_size = file_size
+        self.posts = posts
+        self.photos = photos
+        self.segments = segments
+        self.live_speed = live_speed
+        # change it to simulate new versions of all the media (a different ETag, same size and content).
+        self.media_version = 0
+        self._start_time = time.monotonic()
+        self._rng = random.Random(seed)
+        # the content of every "media" is a slice of this, so it's cheap to serve.
+        self._blob = os.urandom(max(size, file_size) + 65536)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+        # Instagram live: segment start times (t) with the usual ~2000 interval and some jitter.
+        self.segment_times = []
+        t = 100000
+        while len(self.segment_times) < segments:
+            # the first and the last few are always there, like the ones listed in the mpd.
+            if not (missing and 5 < len(self.segment_times) < segments - 5 and self._rng.random() < missing):
+                self.segment_times.append(t)
+            t += self._rng.choices([2000, 1999, 2001, 1998, 2002], weights=[80, 7, 7, 3, 3])[0]
+        self._segment_set = set(self.segment_times)
+
+        self._server = None
+        self._thread = None
+
+    # ---------- server ----------
+    def start(self):
+        cdn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                cdn._handle(self, head=False)
+
+            def do_HEAD(self):
+                cdn._handle(self, head=True)
+
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self._start_time = time.monotonic()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def rewrite(self, url):
+        '''Rewrite a real URL to the mock server, keeping the host as the first path component.'''
+        if url.startswith(self.base_url):
+            return url
+        parts = urlsplit(url)
+        rest = url[len(f'{parts.scheme}://{parts.netloc}'):]
+        return f'{self.base_url}/{parts.hostname}{rest or "/"}'
+
+    # ---------- stats ----------
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {}
+
+    def _count(self, host, key, n=1):
+        with self._lock:
+            host_stats = self.stats.setdefault(host, {'requests': 0, 'bytes': 0, 'errors_injected': 0, 'not_found': 0, 'not_modified': 0})
+            host_stats[key] += n
+
+    # ---------- dispatch ----------
+    def _handle(self, req, head):
+        host, _, path = req.path.lstrip('/').partition('/')
+        path = '/' + path
+        self._count(host, 'requests')
+        if self.latency:
+            time.sleep(self.latency)
+        route = self._routes().get(host)
+        result = route(path) if route else None
+        if result is None:
+            self._count(host, 'not_found')
+            return self._send(req, 404, b'Not Found', head=head)
+        status, body, content_type, *extra = result # (status, body, content type[, extra headers])
+        if content_type == 'media' and self.error_rate and random.random() < self.error_rate:
+            self._count(host, 'errors_injected')
+            return self._send(req, 503, b'Service Unavailable', head=head)
+        if content_type == 'media':
+            return self._send_media(req, host, body, head, etag=f'"{zlib.crc32(path.encode()) ^ self.media_version:08x}"')
+        # conditional requests: an ETag for every (non-media) response, and 304 if it matches If-None-Match.
+        etag = f'"{zlib.crc32(body):08x}"'
+        if req.headers.get('If-None-Match') == etag:
+            self._count(host, 'not_modified')
+            return self._send(req, 304, b'', content_type, {'ETag': etag}, head)
+        self._count(host, 'bytes', len(body))
+        self._send(req, status, body, content_type, {'ETag': etag, **(extra[0] if extra else {})}, head)
+
+    def _send(self, req, status, body, content_type='text/plain', headers=None, head=False):
+        req.send_response(status)
+        req.send_header('Content-Type', content_type)
+        req.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            req.send_header(k, v)
+        req.end_headers()
+        if not head:
+            req.wfile.write(body)
+
+    def _send_media(self, req, host, body, head, etag=None):
+        '''body is a memoryview of the content; supports (single) Range requests, and If-Range with its ETag.'''
+        size = len(body)
+        status, start, end = 200, 0, size - 1
+        if_range = req.headers.get('If-Range')
+        if (m := re.match(r'bytes=(\d*)-(\d*)$', req.headers.get('Range', ''))) and (if_range is None or if_range == etag):
+            if m[1]:
+                start = int(m[1])
+                end = min(int(m[2]), size - 1) if m[2] else size - 1
+            else:
+                start = max(size - int(m[2]), 0)
+            if start >= size:
+                return self._send(req, 416, b'', headers={'Content-Range': f'bytes */{size}'}, head=head)
+            status = 206
+        req.send_response(status)
+        req.send_header('Content-Type', 'application/octet-stream')
+        req.send_header('Content-Length', str(end - start + 1))
+        req.send_header('Accept-Ranges', 'bytes')
+        if etag:
+            req.send_header('ETag', etag)
+        if status == 206:
+            req.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        req.end_headers()
+        if not head:
+            req.wfile.write(body[start:end + 1])
+            self._count(host, 'bytes', end - start + 1)
+
+    def _media(self, key, size=None):
+        size = size or self.size
+        offset = zlib.crc32(key.encode()) % (len(self._blob) - size)
+        return 200, memoryview(self._blob)[offset:offset + size], 'media'
+
+    def _routes(self):
+        return {
+            'instagram.fbcdn.net': self._instagram,
+            'fantia.jp': self._fantia,
+            'cc.fantia.jp': lambda path: self._media(path),
+            'ameblo.jp': self._ameblo,
+            'blogimgapi.ameba.jp': self._ameblo_images_api,
+            'stat.ameba.jp': lambda path: self._media(path),
+            'radiko.jp': self._radiko,
+            'media.radiko.jp': lambda path: self._media(path),
+            'mpn.live.nicovideo.jp': self._nico,
+        }
+
+    @staticmethod
+    def _json(data):
+        return 200, json.dumps(data).encode(), 'application/json'
+
+    # ---------- Instagram ----------
+    def _published(self):
+        '''The number of Instagram segments available now.'''
+        if not self.live_speed:
+            return self.segments
+        return min(self.segments, 5 + int((time.monotonic() - self._start_time) * self.live_speed / 2))
+
+    def _instagram(self, path):
+        if path == '/dash/live/bench.mpd':
+            return 200, self._mpd().encode(), 'application/dash+xml'
+        if m := re.match(r'/dash/live/([va])/17981336783244063_0-(init|\d+)\.m4[va]$', path):
+            if m[2] == 'init' or (int(m[2]) in self._segment_set and self.segment_times.index(int(m[2])) < self._published()):
+                return self._media(path)
+        return None
+
+    def _mpd(self, window=5):
+        published = self._published()
+        times = self.segment_times[max(published - window, 0):published]
+        durations = [b - a for a, b in zip(times, times[1:])] + [2000]
+        timeline = ''.join(f'<S t="{t}" d="{d}"/>' for t, d in zip(times, durations))
+        mpd_type = 'dynamic' if published < self.segments else 'static'
+        # a faster-than-real-time live has shorter segments (and buffer) in real time.
+        speed = self.live_speed or 1
+        return f'''<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="{mpd_type}" availabilityStartTime="2024-05-06T01:21:00-07:00" availabilityEndTime="2024-05-06T01:29:00-07:00" timeShiftBufferDepth="PT{10 / speed:g}S" minimumUpdatePeriod="PT{2 / speed:g}S">
+<Period id="0" start="PT0S">
+<AdaptationSet id="0" mimeType="video/mp4">
+<Representation id="dash-lp-pst-v" bandwidth="2000000" width="720" height="1280" frameRate="30" codecs="avc1.64001f">
+<SegmentTemplate timescale="{int(1000 * speed)}" initialization="v/17981336783244063_0-init.m4v" media="v/17981336783244063_0-$Time$.m4v"><SegmentTimeline>{timeline}</SegmentTimeline></SegmentTemplate>
+</Representation>
+</AdaptationSet>
+<AdaptationSet id="1" mimeType="audio/mp4">
+<Representation id="dash-lp-a" bandwidth="128000" audioSamplingRate="48000" codecs="mp4a.40.2">
+<SegmentTemplate timescale="{int(1000 * speed)}" initialization="a/17981336783244063_0-init.m4a" media="a/17981336783244063_0-$Time$.m4a"><SegmentTimeline>{timeline}</SegmentTimeline></SegmentTemplate>
+</Representation>
+</AdaptationSet>
+</Period>
+</MPD>
+'''
+
+    # ---------- Fantia ----------
+    def _fantia_post(self, id):
+        contents = [{'id': id * 10 + 1, 'post_content_photos': [
+            {'url': {'original': f'https://cc.fantia.jp/uploads/post_content_photo/file/{id}{i}/0123abcd_photo{i}.jpg?Key-Pair-Id=X&Signature=Y'}}
+            for i in range(self.photos)]}]
+        if id % 10 == 0: # every 10th post has a (big) file
+            contents.append({'id': id * 10 + 2, 'download_uri': f'/posts/{id}/download/{id * 10 + 2}', 'filename': f'file{id}.zip'})
+        fanclub = {'id': 1, 'fanclub_name': 'Bench', 'creator_name': 'Creator', 'fanclub_name_with_creator_name': 'Bench (Creator)'}
+        return {'post': {'id': id, 'title': f'Post {id}', 'posted_at': 'Fri, 16 Aug 2024 07:15:36 +0900', 'rating': 'general',
+                         'fanclub': fanclub, 'thumb': {'original': f'https://cc.fantia.jp/uploads/post/file/{id}/cover.jpg'},
+                         'post_contents': contents}}
+
+    def _fantia(self, path):
+        if path == '/':
+            return 200, b'<html><head><meta name="csrf-token" content="benchtoken"></head></html>', 'text/html'
+        if re.match(r'/api/v1/fanclubs/\d+$', path):
+            return self._json({'fanclub': self._fantia_post(0)['post']['fanclub']})
+        if m := re.match(r'/api/v1/posts/(\d+)$', path):
+            return self._json(self._fantia_post(int(m[1])))
+        if m := re.match(r'/fanclubs/\d+/posts\?page=(\d+)$', path):
+            page, per_page = int(m[1]), 20
+            ids = range(self.posts - (page - 1) * per_page, max(self.posts - page * per_page, 0), -1)
+            return 200, ''.join(f'<a href="/posts/{id}">post</a>' for id in ids).encode(), 'text/html'
+        if re.match(r'/posts/\d+/download/\d+$', path):
+            return self._media(path, self.file_size)
+        return None
+
+    # ---------- Ameblo ----------
+    def _ameblo(self, path):
+        if re.match(r'/[\w-]+/$', path):
+            init_data = {'bloggerState': {'bloggerMap': {'1': {'blog': 12345}}}, 'entryState': {'entryMap': {}}}
+            return 200, (f'<html><body><script>window.INIT_DATA = {json.dumps(init_data)};'
+                         'window.RESOURCE_BASE_URL = "/";</script></body></html>').encode(), 'text/html'
+        if m := re.match(r'/_api/blogEntries;blogId=\d+;limit=(\d+);offset=(\d+)$', path):
+            limit, offset = int(m[1]), int(m[2])
+            ids = range(100000 + self.posts - offset, max(100000 + self.posts - offset - limit, 100000), -1)
+            return self._json({'entities': {'entryMap': {str(id): {'publish_flg': 'open'} for id in ids},
+                                            'blogPageMap': {'1': {'paging': {'next': min(offset + limit, self.posts), 'total_count': self.posts}}}}})
+        return None
+
+    def _ameblo_images_api(self, path):
+        if m := re.match(r'/blog/[\w-]+/entries/(\d+)/images$', path):
+            return self._json({'data': [{'imgUrl': f'/user_images/20240101/10/bench/ab/cd/j/t02200293_{m[1]}_{i}.jpg?caw=800',
+                                         'date': '2024-01-01T10:00:00+09:00', 'title': f'entry {m[1]}'} for i in range(self.photos)]})
+        return None
+
+    # ---------- Radiko ----------
+    def _radiko(self, path):
+        if m := re.match(r'/v3/program/station/date/(\d{8})/(\w+)\.xml$', path):
+            date = m[1]
+            xml = (f'<radiko><ttl>1800</ttl><srvtime>0</srvtime><stations><station id="{m[2]}"><name>Bench</name><progs><date>{date}</date>'
+                   f'<prog ft="{date}050000" to="{date}100000"><title>Morning</title></prog>'
+                   f'<prog ft="{date}100000" to="{date}120000"><title>Bench Program</title></prog>'
+                   '</progs></station></stations></radiko>')
+            return 200, xml.encode(), 'text/xml'
+        if path.startswith('/v2/api/auth1'):
+            return 200, b'', 'text/plain', {'X-Radiko-AuthToken': 'benchtoken', 'X-Radiko-KeyLength': '16', 'X-Radiko-KeyOffset': '0'}
+        if path.startswith('/v2/api/auth2'):
+            return 200, b'JP13,tokyo', 'text/plain'
+        if path.startswith('/v2/api/ts/playlist.m3u8'):
+            return 200, b'#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=52973\nhttps://radiko.jp/v2/api/ts/chunklist/bench.m3u8\n', 'application/x-mpegURL'
+        if path == '/v2/api/ts/chunklist/bench.m3u8':
+            lines = ['#EXTM3U'] + [f'#EXTINF:5,\nhttps://media.radiko.jp/sound/b/QRR/20240101/20240101_100000_{i:05d}.aac' for i in range(self.segments)]
+            return 200, '\n'.join(lines).encode(), 'application/x-mpegURL'
+        return None
+
+    # ---------- Nico ----------
+    @staticmethod
+    def _varint(n):
+        out = bytearray()
+        while True:
+            b = n & 0x7F
+            n >>= 7
+            out.append(b | (0x80 if n else 0))
+            if not n:
+                return bytes(out)
+
+    def _nico(self, path):
+        # pip install protobuf
+        from proto.dwango.nicolive.chat.service.edge import payload_pb2 as chat
+
+        if m := re.match(r'/api/view/v4/bench\?&at=(\w+)$', path):
+            entry = chat.ChunkedEntry()
+            if m[1] == 'now':
+                entry.next.at = 1700000000
+            else:
+                entry.backward.segment.uri = 'https://mpn.live.nicovideo.jp/data/backward/v4/bench/0'
+            data = entry.SerializeToString()
+            return 200, self._varint(len(data)) + data, 'application/octet-stream'
+        if m := re.match(r'/data/backward/v4/bench/(\d+)$', path):
+            page = int(m[1])
+            segment = chat.PackedSegment()
+            for i in range(self.photos * 25):
+                message = segment.messages.add()
+                message.meta.id = f'bench-{page}-{i}'
+            if page + 1 < self.posts:
+                segment.next.uri = f'https://mpn.live.nicovideo.jp/data/backward/v4/bench/{page + 1}'
+            return 200, segment.SerializeToString(), 'application/octet-stream'
+        return None
@@ -1,19 +1,30 @@
 import concurrent.futures
+import json
 import re
 import threading
 import time
 import xml.etree.ElementTree as ET
+from collections import Counter
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from shutil import copy2, copyfileobj, get_terminal_size
 from subprocess import run
 from urllib.parse import urljoin
 
 from tqdm import tqdm
-from util import requests_retry_session, get_webname, td_format
+from util import requests_retry_session, get_webname, td_format, host_limiter, profiler, write_stream
 
 
 TOLERANCE = 0.2
+# when backtracking, the guessed ids are probed GUESS_BATCH at a time; the scan around them, SCAN_BATCH at a time.
+GUESS_BATCH = 8
+SCAN_BATCH = 20
+# guesses cover up to MAX_SKIP-1 missing segments in a row.
+MAX_SKIP = 3
+PROBE_HIT = [200, 206, 'Exists']
+# the audio segments are downloaded along with the video ones when backtracking.
+AUDIO_WORKERS = 8
 
 
 def parse_iso8601_duration(duration):
@@ -34,6 +45,69 @@ def parse_iso8601_duration(duration):
     return total_seconds
 
 
+@lru_cache
+def ffmpeg_supports_protocol(protocol):
+    '''Check if the ffmpeg in PATH supports an (input) protocol, e.g. "concatf".'''
+    try:
+        p = run(['ffmpeg', '-hide_banner', '-protocols'], capture_output=True, text=True)
+    except FileNotFoundError:
+        return False
+    # the output is like "Supported file protocols:\nInput:\n  async\n  ...\nOutput:\n  ..."
+    inputs = p.stdout.partition('Input:')[2].partition('Output:')[0]
+    return protocol in inputs.split()
+
+
+def concat_incremental(files, output, verbose=False):
+    '''
+    Concatenate files into one file, like concat(), but only write what changed since the last time.
+
+    The files already in output (name, offset and size) are recorded in "{output}.index.json".
+    Next time, output is truncated at the first file that is different (e.g. a late segment inserted in the middle)
+    and only the files from there are appended; if the files are only appended (e.g. while recording a live), nothing
+    is rewritten at all.
+
+    Returns:
+        int: The number of files written.
+    '''
+    output = Path(output)
+    index_file = output.with_name(output.name + '.index.json')
+    entries = []
+    if output.exists() and index_file.exists():
+        entries = json.loads(index_file.read_text(encoding='utf-8'))
+        # the index is only trusted if it matches the output.
+        if entries and entries[-1]['offset'] + entries[-1]['size'] != output.stat().st_size:
+            print(f'{index_file.name} does not match {output.name}. Rebuild.')
+            entries = []
+    files = [Path(f) for f in files]
+    sizes = [f.stat().st_size for f in files]
+    keep = 0
+    for entry, f, size in zip(entries, files, sizes):
+        if entry['name'] != f.name or entry['size'] != size:
+            break
+        keep += 1
+    if keep == len(files) == len(entries):
+        print(f'{output.name} is up to date.')
+        return 0
+    entries = entries[:keep]
+    offset = entries[-1]['offset'] + entries[-1]['size'] if entries else 0
+    print(f'Keep {keep} files in {output.name}, write {len(files) - keep} files from offset {offset}.')
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open('r+b' if output.exists() else 'wb') as out:
+        out.truncate(offset)
+        out.seek(offset)
+        for f, size in zip(tqdm(files[keep:], ncols=100), sizes[keep:]):
+            if verbose:
+                print(f'Merging {f.name}...')
+            with f.open('rb') as fi:
+                copyfileobj(fi, out)
+            entries.append({'name': f.name, 'offset': offset, 'size': size})
+            offset += size
+    temp_index = index_file.with_name(index_file.name + '.tmp')
+    temp_index.write_text(json.dumps(entries), encoding='utf-8')
+    temp_index.replace(index_file)
+    return len(files) - keep
+
+
 def print_full_width(s):
     '''Print a string to full width of the terminal.'''
     width = get_terminal_size().columns
@@ -56,9 +130,86 @@ def concat(files, output, verbose=False):
     out.close()
 
 
+def parse_xml(content):
+    '''Parse XML (bytes or str) into an Element, with lxml if available (much faster), otherwise xml.etree.'''
+    try:
+        # pip install lxml
+        from lxml import etree
+    except ImportError:
+        return ET.fromstring(content)
+    if isinstance(content, str):
+        # lxml doesn't take str with an encoding declaration.
+        content = content.encode('utf-8')
+    # drop comments, so the children are the same as xml.etree's.
+    return etree.fromstring(content, etree.XMLParser(remove_comments=True, huge_tree=True))
+
+
+class MpdWatcher:
+    '''
+    Poll a live mpd and only report the segments that are new since the last refresh.
+
+    It uses conditional requests (If-None-Match/If-Modified-Since), and skips parsing if the mpd didn't change,
+    so the cost of each poll doesn't grow with the length of the live.
+    Once the mpd is gone for good (a 4xx other than 408/429, e.g. 403/404/410 after the live ends), gone is set to True.
+    gone is also set if the representation at video_index is no longer video_id (the mpd changed its representations),
+    since the new segments would belong to another quality.
+    '''
+    def __init__(self, session, url, video_index, video_id=None):
+        self.session = session
+        self.url = url
+        self.video_index = video_index
+        self.video_id = video_id
+        self.mpd = None
+        self.gone = False
+        self.last_t = None
+        self._content = None
+        self._headers = {}
+
+    def refresh(self):
+        '''
+        Fetch the mpd (if changed) and find the new video segments.
+
+        Returns:
+            tuple: (list of t of the new segments, in order; the latest mpd Element)
+        '''
+        r = self.session.get(self.url, headers=self._headers)
+        if r.status_code == 304:
+            return [], self.mpd
+        if 400 <= r.status_code < 500 and r.status_code not in [408, 429]:
+            self.gone = True
+        r.raise_for_status()
+        self._headers = {}
+        if etag := r.headers.get('ETag'):
+            self._headers['If-None-Match'] = etag
+        if last_modified := r.headers.get('Last-Modified'):
+            self._headers['If-Modified-Since'] = last_modified
+        # servers without validators: the same content means nothing new either.
+        if r.content == self._content:
+            return [], self.mpd
+        self._content = r.content
+        self.mpd = parse_xml(r.content)
+        video_representation = self.mpd[0][0][self.video_index]
+        if self.video_id is not None and video_representation.attrib.get('id') != self.video_id:
+            self.gone = True
+            raise ValueError(f'the video representation {self.video_index} is now {video_representation.attrib.get("id")}, not {self.video_id}')
+        timeline = video_representation[0][0]
+        # the new ones are at the end; walk backward until a known one.
+        new_segments = []
+        for s in reversed(timeline):
+            t = int(s.attrib['t'])
+            if self.last_t is not None and t <= self.last_t:
+                break
+            new_segments.append(t)
+        new_segments.reverse()
+        if new_segments:
+            self.last_t = new_segments[-1]
+        return new_segments, self.mpd
+
+
 class InstaliveDownloader:
     def __init__(self, url, save_path, debug=False, quality=None):
-        self.session = requests_retry_session()
+        # up to 20 threads are used to fetch segments at once.
+        self.session = requests_retry_session(pool_maxsize=20)
         self.url = url
         if save_path is None:
             mpd_name = get_webname(url).split('.')[0]
@@ -81,10 +232,26 @@ class InstaliveDownloader:
         if skip_existing and f.exists() and f.stat().st_size > 0:
             return 'Exists'
         f.parent.mkdir(parents=True, exist_ok=True)
-        with self.session.get(url) as r:
-            if r.status_code == 200:
-                with f.open('wb') as f:
-                    f.write(r.content)
+        # it is streamed into a temp file (outside the segment folders, so an interrupted one never gets merged),
+        # and only renamed to f when complete; so an existing f is always a complete segment.
+        temp_dir = self.save_path / '.dl'
+        temp_dir.mkdir(exist_ok=True)
+        temp_file = temp_dir / f'{f.name}.{threading.get_ident()}'
+        limiter = host_limiter(url)
+        with limiter.slot(), self.session.get(url, stream=True) as r:
+            if r.status_code != 200:
+                return r.status_code
+            expected_size = 0 if r.headers.get('Content-Encoding') else int(r.headers.get('Content-Length', 0))
+            try:
+                with temp_file.open('wb') as fio:
+                    # segments are small (~100KB-1MB) and there are many threads; keep their buffers small too.
+                    written, _ = write_stream(r, fio, limiter=limiter, max_chunk_size=256*1024)
+                if expected_size and written != expected_size:
+                    print(f'\n[W] {f.name}: size does not match (expected: {expected_size}, actual: {written}).')
+                    return 'Incomplete'
+                temp_file.replace(f)
+            finally:
+                temp_file.unlink(missing_ok=True)
             return r.status_code
 
     def save_mpd(self):
@@ -101,7 +268,7 @@ class InstaliveDownloader:
         if not mute:
             print('Fetch mpd...')
         self.mpd_text = self.session.get(self.url).text
-        self.mpd = ET.fromstring(self.mpd_text)
+        self.mpd = parse_xml(self.mpd_text)
         return self.mpd
 
     def parse_mpd(self, quality=None):
@@ -172,8 +339,11 @@ class InstaliveDownloader:
         # find the best interval for iterating heuristically
         d_list = [int(x.attrib['d']) for x in timeline]
         print('Intervals between segments:', ', '.join(str(d) for d in d_list))
-        # get most common interval
-        self.interval = max(set(d_list), key=d_list.count)
+        # keep the distribution (used to guess ids when backtracking), and get most common interval
+        self.interval = Counter(d_list).most_common(1)[0][0]
+        # like the ones learned when backtracking, a d of 1.6x the interval or more is most likely a missing segment,
+        # not an interval to guess with.
+        self.intervals = Counter(d for d in d_list if d < self.interval * 1.6)
         print(f'Heuristically set interval to {self.interval}')
 
         # process audio representations
@@ -209,14 +379,6 @@ class InstaliveDownloader:
         r = self._download(self.audio_init, save_path=self.save_path_audio)
         assert r in [200, 'Exists']
 
-    def _get_segments(self):
-        mpd = self.fetch_mpd(mute=True) # fetch a new mpd to get the latest segments
-        video_representation = mpd[0][0][self.video_index]
-        assert video_representation.attrib['id'] == self.video_id
-        timeline = video_representation[0][0]
-        segments = [int(timeline[i].attrib['t']) for i in range(len(timeline))]
-        return segments, mpd
-
     def manually_set(self, last_t=None):
         if last_t is not None:
             self.last_t = int(last_t)
@@ -233,33 +395,42 @@ class InstaliveDownloader:
         return status
 
     def quick_iterate(self, ids):
+        '''
+        Find a segment among ids: probe them (1-byte ranged requests) with 20 threads, and only download the one found.
+        Once one is found, the rest of the probes (queued or waiting for a slot of the host) are abandoned.
+        '''
         # make sure ids are larger than 0
         ids = [id for id in ids if id > 0]
         print(f'\nUse multi-threading to check {len(ids)} IDs starting from {ids[0]}...')
-        with concurrent.futures.ThreadPoolExecutor(max_workers=20) as ex:
-            futures = {ex.submit(self.fetch_video_by_id, id): id for id in ids}
-            try:
-                for future in concurrent.futures.as_completed(futures):
-                    if future.cancelled():
-                        continue
-                    id = futures[future]
-                    status = future.result()
-                    if status in ['Exists', 200]:
-                        # cancel all other futures
-                        for f in futures:
-                            f.cancel()
-                        return id, status
-            # TODO: does not work since we call it in a thread.
-            except KeyboardInterrupt:
-                print('\nInterrupted. Cancel all futures...')
-                for f in futures:
-                    f.cancel()
-                raise KeyboardInterrupt
-        return None, None
-
-    def download_live(self):
-        downloaded = set()
+        found = threading.Event()
+        valid_id = None
+        ex = concurrent.futures.ThreadPoolExecutor(max_workers=20)
+        try:
+            futures = {ex.submit(self.probe_video_by_id, id, found): id for id in ids}
+            for future in concurrent.futures.as_completed(futures):
+                if future.result() in PROBE_HIT:
+                    valid_id = futures[future]
+                    break
+        # TODO: does not work since we call it in a thread.
+        except KeyboardInterrupt:
+            print('\nInterrupted. Cancel all futures...')
+            raise
+        finally:
+            found.set()
+            ex.shutdown(wait=True, cancel_futures=True)
+        if valid_id is None:
+            return None, None
+        return valid_id, self.fetch_video_by_id(valid_id)
 
+    def download_live(self, workers=8):
+        '''
+        Record the live stream: poll the mpd and download new segments (video and audio at the same time) in a thread pool,
+        so polling is never blocked by downloads. The poll interval adapts to the segment duration / minimumUpdatePeriod,
+        and shortens when several new segments show up at once (i.e. we're lagging behind the live edge).
+
+        Returns:
+            list: The ids of the segments that still failed after all the retries (for repair()).
+        '''
         mpd = self.mpd
         # check if mpd is dynamic
         if mpd.attrib.get('type') != 'dynamic':
@@ -267,41 +438,124 @@ class InstaliveDownloader:
             return
         # use minimumUpdatePeriod if available. otherwise, use timeShiftBufferDepth/2-1 as the interval.
         # make sure it is at least 2s.
-        fetch_interval = parse_iso8601_duration(mpd.attrib.get('minimumUpdatePeriod', 'PT0S')) \
+        base_interval = parse_iso8601_duration(mpd.attrib.get('minimumUpdatePeriod', 'PT0S')) \
             or parse_iso8601_duration(mpd.attrib.get('timeShiftBufferDepth', 'PT0S')) // 2 - 1
-        fetch_interval = max(fetch_interval, 2)
+        base_interval = max(base_interval, 2)
+        # never wait so long that segments fall out of the time shift buffer.
+        buffer_depth = parse_iso8601_duration(mpd.attrib.get('timeShiftBufferDepth', 'PT0S')) or base_interval * 4
+        max_interval = max(buffer_depth / 3, 1)
+        min_interval = 0.5
+        fetch_interval = min(base_interval, max_interval)
 
         MAX_IDLE_COUNT = 20
+        MAX_RETRIES = 3
+        # give up after this many failed mpd fetches in a row (with exponential backoff in between, ~30s in total),
+        # so a live that has ended (and its mpd gone) doesn't keep us polling forever.
+        MAX_FETCH_FAILURES = 6
+
+        # only the new segments are reported by the watcher, so nothing here grows with the length of the live.
+        watcher = MpdWatcher(self.session, self.url, self.video_index, self.video_id)
+        failed = []
+        given_up = set()
+        attempts = Counter()
+        lock = threading.Lock()
+
+        def on_done(id, future):
+            # failed ones are retried on the next poll.
+            if future.exception() is not None or future.result() not in [200, 'Exists']:
+                with lock:
+                    attempts[id] += 1
+                    if attempts[id] < MAX_RETRIES:
+                        failed.append(id)
+                    else:
+                        given_up.add(id)
+                        print(f'\n[W] Failed to download segment {id}.')
+
+        def submit(ex, ids):
+            for id in ids:
+                ex.submit(self.fetch_video_by_id, id).add_done_callback(lambda f, id=id: on_done(id, f))
+                ex.submit(self.fetch_audio_by_id, id).add_done_callback(lambda f, id=id: on_done(id, f))
 
+        first_poll = True
         unchanged_mpd_count = 0
-        while True:
-            new_segments, mpd = self._get_segments()
-            if all(id in downloaded for id in new_segments):
-                unchanged_mpd_count += 1
-                if unchanged_mpd_count >= MAX_IDLE_COUNT:
-                    if mpd.attrib.get('type') == 'dynamic':
+        fetch_failures = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+            while True:
+                start = time.monotonic()
+                try:
+                    new_segments, mpd = watcher.refresh()
+                except Exception as e:
+                    fetch_failures += 1
+                    if watcher.gone:
+                        print(f'[W] Stop watching the mpd ({e}). Assume the live has ended.')
+                        break
+                    if fetch_failures >= MAX_FETCH_FAILURES:
+                        print(f'[W] Failed to fetch mpd {fetch_failures} times in a row ({e}). Assume the live has ended. Stop.')
+                        break
+                    delay = min(min_interval * 2 ** fetch_failures, 30)
+                    print(f'[W] Failed to fetch mpd ({e}). Retry in {delay:.0f}s...')
+                    time.sleep(delay)
+                    continue
+                fetch_failures = 0
+                with lock:
+                    retries = failed[:]
+                    failed.clear()
+                undownloaded = list(dict.fromkeys(retries + new_segments))
+                if not undownloaded:
+                    # the live has ended; nothing more will come.
+                    if mpd.attrib.get('type') != 'dynamic':
+                        print('All segments are downloaded. Stop.')
+                        break
+                    unchanged_mpd_count += 1
+                    if unchanged_mpd_count >= MAX_IDLE_COUNT:
                         print(f'No new segments found in the last {MAX_IDLE_COUNT} checks. But the mpd is still dynamic. Continue monitoring...')
+                        unchanged_mpd_count = 0
+                    # nothing new yet: back off a little, up to the base interval.
+                    fetch_interval = min(fetch_interval * 1.25, base_interval, max_interval)
+                else:
+                    unchanged_mpd_count = 0
+                    print(f'{len(undownloaded)} new segments found. Downloading...')
+                    submit(ex, undownloaded)
+                    if len(new_segments) > 1 and not first_poll:
+                        # more than one new segment since the last poll: we're lagging, poll sooner.
+                        fetch_interval = max(fetch_interval / 2, min_interval)
                     else:
-                        print('All segments are downloaded. Stop.')
-                        return
-            else:
-                undownloaded = [id for id in new_segments if id not in downloaded]
-                print(f'{len(undownloaded)} new segments found. Downloading...')
-                for id in undownloaded:
-                    # singe-thread should be enough for live stream
-                    self.fetch_video_by_id(id)
-                    self.fetch_audio_by_id(id)
-                    downloaded.add(id)
+                        # about one per poll: poll once per segment.
+                        fetch_interval = min(max(self._segment_duration(mpd), min_interval), max_interval)
+                first_poll = False
+                # the time spent fetching the mpd counts towards the interval.
+                time.sleep(max(fetch_interval - (time.monotonic() - start), 0))
+
+        # the ones that failed after the last poll (or while the pool was finishing) would wait for a poll that never comes:
+        # retry them now, until they succeed or run out of retries.
+        while failed:
+            retries = list(dict.fromkeys(failed))
+            failed.clear()
+            print(f'Retry {len(retries)} failed segments...')
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as ex:
+                submit(ex, retries)
+        if given_up:
+            print(f'[W] {len(given_up)} segments are not downloaded: {sorted(given_up)}. Use check() and repair() to get them.')
+        return sorted(given_up)
 
-            time.sleep(fetch_interval)
+    def _segment_duration(self, mpd):
+        '''The duration (in seconds) of the latest video segment in mpd.'''
+        template = mpd[0][0][self.video_index][0]
+        timescale = int(template.attrib.get('timescale', 1000))
+        return int(template[0][-1].attrib['d']) / timescale
 
-    def download_video(self, forward=False):
+    @profiler.profile()
+    def download_video(self, forward=False, audio=False):
+        '''
+        Download the video segments by backtracking from last_t (or forward if forward is True).
+        If audio is True, the audio segment of each video segment found is downloaded at the same time (in a separate pool),
+        so there is no need to call download_audio() afterwards.
+        '''
         count = 0
-        known_intervals = {
-            self.interval: 0,
-            self.interval - 1: 0,
-            self.interval + 1: 0,
-        }
+        audio_futures = {}
+        # the distribution of segment durations: seeded with the ones in the mpd's timeline, and updated as we go.
+        known_intervals = Counter(self.intervals)
+        known_intervals.update({self.interval - 1: 0, self.interval + 1: 0})
         id_guesses = [self.last_t]
         prev_id = None
         sign = 1 if forward else -1
@@ -313,142 +567,341 @@ class InstaliveDownloader:
             ids.sort(key=lambda k: abs(k - x))
             return ids
 
-        while True:
-            valid_id = None
-            # firstly, we try to find if existing local file that is close to the guesses[0].
-            # which is defined as +/- TOLERANCE (default: 20%) of the interval.
-            # this is a "narrower" window than surrounding() function.
-            # notice that we don't need to try all the guesses, they will be checked in the
-            # next step.
-            ids = list(range(id_guesses[0] - int(self.interval*TOLERANCE), id_guesses[0] + int(self.interval*TOLERANCE) + 1))
-            ids.sort(key=lambda k: abs(k - id_guesses[0]))
-            # only try ids that are before the prev_id (if backward) or after the prev_id (if forward).
-            if prev_id:
-                ids = [id for id in ids if (id - prev_id) * sign > 0]
-            for candidate in ids:
-                url = self.video_url_template.format(candidate)
-                f = self.save_path_video / get_webname(url)
-                if f.exists() and f.stat().st_size > 0:
-                    valid_id = candidate
-                    print_full_width(f'Segment {valid_id}: {f} already exists. Skip.')
-                    break
-            # if not found locally, we try to fetch the segment by id from the all
-            # (last_valid_id - potential_interval) pools.
-            # The order matters: we try the most common interval first.
-            # this is single-threaded, because it is more time-consuming trying to close all the threads.
-            if not valid_id:
-                for candidate in id_guesses:
-                    status = self.fetch_video_by_id(candidate)
-                    print_full_width(f'Segment {candidate}: HTTP {status}')
-                    if status in [200, 'Exists']:
-                        valid_id = candidate
-                        break
-            # If still not found, we iterate around the guesses[0] to find the next segment.
-            # the range is defined as 50%+TOLERANCE behind of x and 100%+TOLERANCE ahead of x,
-            # where x is the guesses[0].
-            # e.g. for 2000 interval, x = last_id - 2000, the range would be
-            # last_id - 800 to last_id - 4400, sorted by distance to last_id - 2000.
-            # notice that it covers up to the range of next next id, this way we ensure we still
-            # continue the downloading instead of stopping too early (despite missing a segment).
-            if not valid_id:
-                ids = [id for id in surrounding(id_guesses[0]) if id not in id_guesses]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_BATCH) as ex, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=AUDIO_WORKERS) as audio_ex:
+            while True:
+                valid_id = None
+                # firstly, we try to find if existing local file that is close to the guesses[0].
+                # which is defined as +/- TOLERANCE (default: 20%) of the interval.
+                # this is a "narrower" window than surrounding() function.
+                # notice that we don't need to try all the guesses, they will be checked in the
+                # next step.
+                ids = list(range(id_guesses[0] - int(self.interval*TOLERANCE), id_guesses[0] + int(self.interval*TOLERANCE) + 1))
+                ids.sort(key=lambda k: abs(k - id_guesses[0]))
+                # only try ids that are before the prev_id (if backward) or after the prev_id (if forward).
                 if prev_id:
                     ids = [id for id in ids if (id - prev_id) * sign > 0]
-                valid_id, status = self.quick_iterate(ids)
-                # if still not, we assume we downloaded them all and stop.
+                for candidate in ids:
+                    url = self.video_url_template.format(candidate)
+                    f = self.save_path_video / get_webname(url)
+                    if f.exists() and f.stat().st_size > 0:
+                        valid_id = candidate
+                        print_full_width(f'Segment {valid_id}: {f} already exists. Skip.')
+                        break
+                # if not found locally, we simply download the most likely one: it is right most of the time.
+                if not valid_id:
+                    status = self.fetch_video_by_id(id_guesses[0])
+                    print_full_width(f'Segment {id_guesses[0]}: HTTP {status}')
+                    if status in [200, 'Exists']:
+                        valid_id = id_guesses[0]
+                # otherwise, probe (1-byte ranged requests, in batches) the other guesses, by probability;
+                # they also cover one or two missing segments in a row (in which case, the ids in between are
+                # probed too, in case the intervals are just irregular).
+                # If still not found, we probe around the guesses[0] to find the next segment.
+                # the range is defined as 50%+TOLERANCE behind of x and 100%+TOLERANCE ahead of x,
+                # where x is the guesses[0].
+                # e.g. for 2000 interval, x = last_id - 2000, the range would be
+                # last_id - 800 to last_id - 4400, sorted by distance to last_id - 2000.
+                # notice that it covers up to the range of next next id, this way we ensure we still
+                # continue the downloading instead of stopping too early (despite missing a segment).
+                # Only the one found is downloaded.
                 if not valid_id:
-                    print("\nFailed to find next segment. Assume we downloaded all. Stop.")
+                    valid_id = self._probe_first(id_guesses[1:], ex, GUESS_BATCH)
+                    single = set(self._guess_ids(prev_id, known_intervals, sign, max_skip=1)) if prev_id else set()
+                    if valid_id and prev_id and valid_id not in single:
+                        # the hit assumes missing segments in between; make sure we don't skip one silently.
+                        # only the ids splitting it into two intervals both in the window of the known ones are
+                        # plausible (anything else needs an interval we've never seen), and those are normally
+                        # probed as guesses already, so this rarely costs a request.
+                        window = self._interval_window(known_intervals)
+                        ids = [prev_id + x * sign for x in window]
+                        ids = [id for id in ids if abs(valid_id - id) in window and id not in single]
+                        if ids:
+                            ids.sort(key=lambda k: abs(k - id_guesses[0]))
+                            print(f'\nProbe {len(ids)} IDs between {prev_id} and {valid_id}...')
+                            valid_id = self._probe_first(ids, ex, SCAN_BATCH) or valid_id
+                    if not valid_id:
+                        guessed = set(id_guesses)
+                        ids = [id for id in surrounding(id_guesses[0]) if id not in guessed]
+                        if prev_id:
+                            ids = [id for id in ids if (id - prev_id) * sign > 0]
+                        print(f'\nProbe {len(ids)} IDs around {id_guesses[0]}...')
+                        valid_id = self._probe_first(ids, ex, SCAN_BATCH)
+                    # if still not, we assume we downloaded them all and stop.
+                    if not valid_id:
+                        print("\nFailed to find next segment. Assume we downloaded all. Stop.")
+                        break
+                    status = self.fetch_video_by_id(valid_id)
+                    print_full_width(f'Segment {valid_id}: HTTP {status}')
+                    if status not in [200, 'Exists']:
+                        print(f'\n[W] Segment {valid_id} exists but failed to download (HTTP {status}).')
+                # at this point, we should have a valid_id.
+                assert valid_id
+                if audio:
+                    audio_futures[valid_id] = audio_ex.submit(self.fetch_audio_by_id, valid_id)
+                # add new interval to known_intervals
+                if prev_id:
+                    new_interval = abs(valid_id - prev_id)
+                    assert new_interval > 0 # this should not happen.
+                    # do not add new interval if it is too different from the current interval.
+                    # for example, if the nominal interval is 2000, we should only add ones that are
+                    # less than 3000. Otherwise we enables the possibility of skipping segments.
+                    # But it is still allowed to have such large interval so we don't stop downloading
+                    # in the middle just because of one missing segment.
+                    if new_interval >= self.interval * 1.6:
+                        pass
+                    # add interval to known_intervals (if not already), and increase the count.
+                    else:
+                        known_intervals[new_interval] += 1
+
+                # print(f'[Debug] known_intervals: {known_intervals}')
+                count += 1
+                if self.debug and count == 30:
                     break
-                print_full_width(f'Segment {valid_id}: HTTP {status}')
-            # at this point, we should have a valid_id.
-            assert valid_id
-            # add new interval to known_intervals
-            if prev_id:
-                new_interval = abs(valid_id - prev_id)
-                assert new_interval > 0 # this should not happen.
-                # do not add new interval if it is too different from the current interval.
-                # for example, if the nominal interval is 2000, we should only add ones that are
-                # less than 3000. Otherwise we enables the possibility of skipping segments.
-                # But it is still allowed to have such large interval so we don't stop downloading
-                # in the middle just because of one missing segment.
-                if new_interval >= self.interval * 1.6:
-                    pass
-                # add interval to known_intervals (if not already), and increase the count.
-                else:
-                    known_intervals.setdefault(new_interval, 0)
-                    known_intervals[new_interval] += 1
+                prev_id = valid_id
+                id_guesses = self._guess_ids(valid_id, known_intervals, sign)
 
-            # print(f'[Debug] known_intervals: {known_intervals}')
-            count += 1
-            if self.debug and count == 30:
-                break
-            prev_id = valid_id
-            # sort known_intervals by appearance, so we try the most common interval first.
-            known_intervals = dict(sorted(known_intervals.items(), key=lambda x: x[1], reverse=True))
-            id_guesses = [valid_id + interval * sign for interval in known_intervals]
+            if audio_futures:
+                print(f'\nWait for {sum(not f.done() for f in audio_futures.values())} audio segments...')
+                failed = []
+                for id, f in audio_futures.items():
+                    # an exception is just another failure: the rest still need to be checked.
+                    try:
+                        status = f.result()
+                    except Exception as e:
+                        status = e
+                    if status not in [200, 'Exists']:
+                        failed.append(id)
+                if failed:
+                    print(f'[W] Failed to download {len(failed)} audio segments: {failed}')
+
+    def _guess_ids(self, id, intervals, sign, max_skip=MAX_SKIP):
+        '''
+        Guess the id of the segment next to id (in the direction of sign).
+        The guesses one interval away come first, the most probable first: each interval's probability comes from
+        its count in intervals (+1 so unseen ones are still tried), followed by the rest of a small window around them
+        in case of an interval we haven't seen yet.
+        Then the ones assuming k-1 segments are missing in between (the sum of k intervals), again by probability.
+        '''
+        total = sum(intervals.values()) + len(intervals)
+        probs = {interval: (n + 1) / total for interval, n in intervals.items()}
+        guesses = sorted(probs, key=probs.get, reverse=True)
+        guesses += sorted((x for x in self._interval_window(intervals) if x not in probs), key=lambda x: abs(x - self.interval))
+        offsets = probs
+        for _ in range(max_skip - 1):
+            step = {}
+            for offset, p in offsets.items():
+                for interval, q in probs.items():
+                    step[offset + interval] = step.get(offset + interval, 0) + p * q
+            offsets = step
+            guesses += sorted(offsets, key=offsets.get, reverse=True)
+        ids = [id + x * sign for x in guesses]
+        # de-duplicate, keeping the order.
+        return [id for id in dict.fromkeys(ids) if id > 0]
+
+    def _interval_window(self, intervals):
+        '''
+        The range of intervals a segment is looked for at: the known intervals plus a little jitter,
+        but never more than 5% off the interval, so a few odd ones don't make every guess a scan.
+        '''
+        jitter = max(2, self.interval // 100)
+        limit = max(jitter, self.interval // 20)
+        low = max(min(intervals) - jitter, self.interval - limit)
+        high = min(max(intervals) + jitter, self.interval + limit)
+        return range(low, high + 1)
+
+    def _probe(self, url, save_path, cancel=None):
+        '''
+        Check if a segment exists without downloading it: either locally, or with a 1-byte ranged request
+        (both 200 and 206 mean it exists).
+        Returns None without any request if cancel (a threading.Event) is set before it gets its turn.
+        '''
+        f = Path(save_path) / get_webname(url)
+        if f.exists() and f.stat().st_size > 0:
+            return 'Exists'
+        if cancel is not None and cancel.is_set():
+            return None
+        with host_limiter(url).slot():
+            # waiting for the slot could take a while.
+            if cancel is not None and cancel.is_set():
+                return None
+            with self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as r:
+                # a server (or proxy) ignoring Range answers 200 with the whole segment: close it without reading.
+                # otherwise, the body is tiny; read it so the connection goes back to the pool.
+                if r.status_code != 200:
+                    r.content
+                return r.status_code
+
+    def probe_video_by_id(self, id, cancel=None):
+        url = self.video_url_template.format(id)
+        return self._probe(url, self.save_path_video, cancel)
+
+    def _probe_first(self, ids, ex, batch):
+        '''
+        Probe ids in order, batch by batch (in parallel within a batch); return the first one that exists.
+        The batches grow from 1 to batch, so a hit among the first few ids doesn't pay for a whole batch of probes.
+        '''
+        ids = [id for id in ids if id > 0]
+        i, size = 0, 1
+        while i < len(ids):
+            chunk = ids[i:i + size]
+            for id, status in zip(chunk, ex.map(self.probe_video_by_id, chunk)):
+                if status in PROBE_HIT:
+                    return id
+            i += size
+            size = min(size * 2, batch)
+        return None
 
     def check(self):
+        '''
+        Check if there is any missing video segment, i.e. gaps between downloaded segments larger than the interval (+TOLERANCE).
+        Every gap is reported, with an estimation of how many segments are missing in it.
+
+        Returns:
+            list: [(id before the gap, id after the gap), ...], the largest gap first.
+        '''
         print('Check if there is any missing video segment...')
-        files = list(self.save_path_video.iterdir())
         # filename format: 17981336783244063_0-1297029.m4v
-        ids = [int(m[1]) for f in files if (m := re.search(r'\d+_0-(\d+)', f.name))]
-        ids.sort()
+        ids = sorted(int(m[1]) for f in self.save_path_video.iterdir() if (m := re.search(r'\d+_0-(\d+)', f.name)))
+        if len(ids) < 2:
+            print(f'Only {len(ids)} segments found. Nothing to check.')
+            return []
         # calculate difference between each id
-        diffs = [ids[i+1] - ids[i] for i in range(len(ids)-1)]
+        diffs = [b - a for a, b in zip(ids, ids[1:])]
 
-        diff_count = {}
-        for diff in diffs:
-            diff_count[diff] = diff_count.get(diff, 0) + 1
-        print(f'Count of diff values between each segment:', diff_count)
+        print(f'Count of diff values between each segment:', dict(sorted(Counter(diffs).items())))
         max_idx = diffs.index(max(diffs))
-        print(f'Largest ID diff between each segment: {max(diffs)}, at {ids[max_idx]} -> {ids[max_idx+1]}')
+        print(f'Largest ID diff between each segment: {diffs[max_idx]}, at {ids[max_idx]} -> {ids[max_idx+1]}')
         min_idx = diffs.index(min(diffs))
-        print(f'Smallest ID diff between each segment: {min(diffs)}, at {ids[min_idx]} -> {ids[min_idx+1]}')
+        print(f'Smallest ID diff between each segment: {diffs[min_idx]}, at {ids[min_idx]} -> {ids[min_idx+1]}')
 
         # Check if there are any missing segments, defined as gaps larger than 1.2 times the interval.
-        if max(diffs) > self.interval * (1+TOLERANCE):
-            print(f'It is likely that the video is not fully downloaded!!')
-            return (ids[max_idx], ids[max_idx+1])
-        else:
+        threshold = self.interval * (1+TOLERANCE)
+        gap_idx = [i for i, diff in enumerate(diffs) if diff > threshold]
+        if not gap_idx:
             print('No missing segment found.')
+            return []
+        # the typical interval is the average of the ones that aren't gaps.
+        normal = [diff for diff in diffs if diff <= threshold]
+        typical = sum(normal) / len(normal) if normal else self.interval
+        gap_idx.sort(key=lambda i: -diffs[i])
+        missing = [max(round(diffs[i] / typical) - 1, 1) for i in gap_idx]
+        print(f'It is likely that the video is not fully downloaded!! {len(gap_idx)} gaps, ~{sum(missing)} segments missing:')
+        for i, n in zip(gap_idx, missing):
+            print(f'  {ids[i]} -> {ids[i+1]} (diff: {diffs[i]}, ~{n} missing)')
+        return [(ids[i], ids[i+1]) for i in gap_idx]
+
+    def repair(self, gaps, workers=4):
+        '''
+        Look for the missing segments in gaps (from check()), all of them in parallel, and download them (video and audio).
+
+        Returns:
+            list: The ids of the segments found.
+        '''
+        found = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SCAN_BATCH) as ex, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=workers) as gap_ex:
+            futures = {gap_ex.submit(self._repair_gap, start, end, ex): (start, end) for start, end in gaps}
+            for future in concurrent.futures.as_completed(futures):
+                start, end = futures[future]
+                ids = future.result()
+                print(f'Gap {start} -> {end}: found {len(ids)} segments.')
+                found += ids
+        found.sort()
+        return found
 
+    def _repair_gap(self, start, end, ex):
+        '''Find and download all the segments between start and end (exclusive); probes are run in ex.'''
+        found = []
+        gaps = [(start, end)]
+        while gaps:
+            start, end = gaps.pop()
+            if end - start <= self.interval * (1+TOLERANCE):
+                continue
+            # the guesses from the interval distribution first, then everything in between (closest to one interval first).
+            guesses = [id for id in self._guess_ids(start, self.intervals, 1) if id < end]
+            valid_id = self._probe_first(guesses, ex, GUESS_BATCH)
+            if valid_id is None:
+                ids = sorted(range(start + 1, end), key=lambda k: abs(k - start - self.interval))
+                valid_id = self._probe_first(ids, ex, SCAN_BATCH)
+            if valid_id is None:
+                continue
+            status = self.fetch_video_by_id(valid_id)
+            if status not in [200, 'Exists']:
+                print(f'[W] Segment {valid_id} exists but failed to download (HTTP {status}).')
+                continue
+            self.fetch_audio_by_id(valid_id)
+            found.append(valid_id)
+            # there could be more on either side.
+            gaps += [(start, valid_id), (valid_id, end)]
+        return found
 
-    def download_audio(self):
+    def download_audio(self, ids=None):
+        '''Download the audio segments of ids, or (by default) of all the downloaded video segments.'''
         print('Downloading audio segments...')
-        files = list(self.save_path_video.iterdir())
+        if ids is None:
+            ids = [m[1] for f in self.save_path_video.iterdir() if f.is_file() and (m := re.search(r'_0-(init|\d+)\.m4v$', f.name))]
         with concurrent.futures.ThreadPoolExecutor(max_workers=20) as ex:
-            futures = []
             count = 0
-            for f in files:
-                if not f.is_file():
-                    continue
-                if f.suffix != '.m4v':
-                    continue
-                id = re.search(r'_0-(init|\d+)\.m4v', f.name)[1]
-                url = self.audio_url_template.format(id)
-                futures.append(ex.submit(self._download, url, save_path=self.save_path_audio))
+            futures = [ex.submit(self.fetch_audio_by_id, id) for id in ids]
             for _ in concurrent.futures.as_completed(futures):
                 count += 1
                 print(f'Finished {count}/{len(futures)}         ', end='\r')
 
-    def merge(self):
+    def _segment_files(self, folder):
+        '''The segment files in folder, in order (init segment first).'''
         def get_key(f):
             '''Make sure init segment is always at the beginning.'''
             if '-init' in f.name:
                 return 0
             return int(re.search(r'\d+_0-(\d+)', f.name)[1])
 
-        video_file = self.save_path / 'video.m4v'
-        files = list(self.save_path_video.iterdir())
-        print(f'Find {len(files)} video segments. Merging...')
+        files = [f for f in folder.iterdir() if f.is_file()]
         files.sort(key=get_key)
-        concat(files, video_file)
+        return files
+
+    def merge(self, mode='auto'):
+        '''
+        Merge the downloaded video and audio segments into merged.mp4.
+
+        Args:
+            mode (str): "stream": ffmpeg reads the segments directly (via its concatf: protocol and a list of files),
+                so no intermediate files are written.
+                "files": concatenate the segments into video.m4v and audio.m4a first, then remux them with ffmpeg.
+                The concatenation is incremental (see concat_incremental()): running it again after more segments
+                are downloaded (late ones found by "manual", or new ones while recording) only writes those.
+                "auto" (default): "stream" if the ffmpeg supports concatf: (5.1+), otherwise "files".
+        '''
+        if mode == 'auto':
+            mode = 'stream' if ffmpeg_supports_protocol('concatf') else 'files'
+        video_files = self._segment_files(self.save_path_video)
+        print(f'Find {len(video_files)} video segments.')
+        audio_files = self._segment_files(self.save_path_audio)
+        print(f'Find {len(audio_files)} audio segments.')
 
+        if mode == 'stream':
+            # the segments are fragmented mp4, so the byte concatenation of them (what concatf: reads) is a valid file.
+            temp_dir = self.save_path / '.dl'
+            temp_dir.mkdir(exist_ok=True)
+            video_list = temp_dir / 'video.txt'
+            video_list.write_text('\n'.join(f.resolve().as_posix() for f in video_files), encoding='utf-8')
+            audio_list = temp_dir / 'audio.txt'
+            audio_list.write_text('\n'.join(f.resolve().as_posix() for f in audio_files), encoding='utf-8')
+            print(f'Merging video and audio using FFMPEG (without intermediate files)...')
+            try:
+                run(['ffmpeg', '-loglevel', 'error', '-stats', '-i', f'concatf:{video_list.resolve().as_posix()}',
+                     '-i', f'concatf:{audio_list.resolve().as_posix()}', '-c', 'copy', self.save_path/'merged.mp4'])
+            finally:
+                video_list.unlink()
+                audio_list.unlink()
+            return
+
+        video_file = self.save_path / 'video.m4v'
+        print('Merging video segments...')
+        concat_incremental(video_files, video_file)
         audio_file = self.save_path / 'audio.m4a'
-        files2 = list(self.save_path_audio.iterdir())
-        print(f'Find {len(files2)} audio segments. Merging...')
-        files2.sort(key=get_key)
-        concat(files2, audio_file)
+        print('Merging audio segments...')
+        concat_incremental(audio_files, audio_file)
 
         print(f'Merging video and audio using FFMPEG...')
         run(['ffmpeg', '-loglevel', 'error', '-stats', '-i', video_file, '-i', audio_file, '-c', 'copy', self.save_path/'merged.mp4'])
@@ -479,7 +932,7 @@ class InstaliveDownloader:
                             copy2(f, newf)
 
 
-def main(url, save_path, time, debug, action, quality):
+def main(url, save_path, time, debug, action, quality, merge_mode='auto'):
     downloader = InstaliveDownloader(url=url, save_path=save_path, debug=debug, quality=quality)
     if time is not None:
         downloader.manually_set(time)
@@ -497,17 +950,14 @@ def main(url, save_path, time, debug, action, quality):
         if action == 'all':
             downloader.save_mpd()
             downloader.download_init()
-            def task1():
-                downloader.download_video()
-                downloader.download_audio()
-            t1 = threading.Thread(target=task1)
+            t1 = threading.Thread(target=downloader.download_video, kwargs={'audio': True})
             t2 = threading.Thread(target=downloader.download_live)
             t1.start()
             t2.start()
             t1.join()
             t2.join()
             downloader.check()
-            downloader.merge()
+            downloader.merge(merge_mode)
         elif action == 'live':
             downloader.save_mpd()
             downloader.download_live()
@@ -518,27 +968,29 @@ def main(url, save_path, time, debug, action, quality):
         elif action == 'audio':
             downloader.download_audio()
         elif action == 'merge':
-            downloader.merge()
+            downloader.merge(merge_mode)
         elif action == 'check':
             downloader.check()
         elif action == 'manual':
             if args.range:
                 start, end = map(int, args.range.split('-'))
                 print(f'manually set range to from {start} to {end} (inclusive)')
+                ids = list(range(start, end + 1)) if start < end else list(range(start, end - 1, -1))
+                id, status = downloader.quick_iterate(ids)
+                if not id:
+                    print('No segment found in this range.')
+                else:
+                    print(f'Found segment {id} with status {status}')
             else:
-                worst = downloader.check()
-                if not worst:
+                gaps = downloader.check()
+                if not gaps:
                     print('No bad interval found. Stop.')
                     return
-                start = worst[0] + 1
-                end = worst[1] - 1
-                print(f'Automatically check the largest interval, between {start} and {end} (inclusive)')
-            ids = list(range(start, end + 1)) if start < end else list(range(start, end - 1, -1))
-            id, status = downloader.quick_iterate(ids)
-            if not id:
-                print('No segment found in this range.')
-            else:
-                print(f'Found segment {id} with status {status}')
+                print(f'Automatically check all the {len(gaps)} gaps...')
+                found = downloader.repair(gaps)
+                print(f'Found {len(found)} missing segments.')
+                if found:
+                    downloader.check()
 
     except KeyboardInterrupt:
         print('\nInterrupted by user. Stop.')
@@ -555,7 +1007,7 @@ if __name__ == '__main__':
                     '  audio    - Download audio only\n'
                     '  merge    - Merge downloaded video and audio\n'
                     '  check    - Check the downloaded segments to make sure there are no missing segments\n'
-                    '  manual   - Manually check missing segments at the largest gap (or use --range to assign a range) (for debugging only)\n'
+                    '  manual   - Find and download the missing segments in all the gaps found by check (or use --range to assign a range) (for debugging only)\n'
                     '  info     - Display downloader object info\n'
                     '  import:<path> - Import segments downloaded via N_m3u8DL-RE from a given path',
         formatter_class=argparse.RawTextHelpFormatter
@@ -569,10 +1021,14 @@ if __name__ == '__main__':
                         "(default: \"pst\": which is the \"original\" (?) and has the best bitrate,\n"
                         "but not necessarily the highest resolution.\n"
                         "Pass empty string or \"highest\" to use the highest resolution one.)")
+    parser.add_argument("--merge-mode", choices=['auto', 'stream', 'files'], default='auto', help="how to merge the segments (default: auto):\n"
+                        "\"stream\": let ffmpeg read the segments directly (needs ffmpeg 5.1+), no intermediate files;\n"
+                        "\"files\": concatenate them into video.m4v and audio.m4a first;\n"
+                        "\"auto\": \"stream\" if supported, otherwise \"files\".")
     parser.add_argument("--time", "-t", help="for debugging only; manually assign last t (default: auto)")
     parser.add_argument('--range', help='for debugging only; manually assign iteration range (start,end) for manual action')
 
     args = parser.parse_args()
 
-    main(args.url, args.dir, args.time, args.debug, args.action, args.quality)
+    main(args.url, args.dir, args.time, args.debug, args.action, args.quality, args.merge_mode)
 
@@ -7,6 +7,8 @@ from urllib.parse import unquote, urljoin
 import requests
 from bs4 import BeautifulSoup
 
+from util import format_speed, write_stream
+
 
 def get_webname(url):
     return unquote(url.split('?')[0].split('/')[-1])
@@ -28,21 +30,21 @@ def bytes_to_kb(bytes):
     return f'{bytes/1024:.3f} KB'
 
 def download(url_or_res, f):
+    '''Download into f. Returns the speed (e.g. "1.23 MB/s").'''
     if isinstance(url_or_res, str):
         r = requests.get(url_or_res, stream=True)
     else:
         r = url_or_res
 
-    with f.open('wb') as fio:
-        for chunk in r.iter_content(chunk_size=8192):
-            if chunk:
-                fio.write(chunk)
+    with r, f.open('wb') as fio:
+        written, seconds = write_stream(r, fio)
+    return format_speed(written, seconds)
 
 def get_orig(url, save_dir='.', test_mode=False, bad_file='delete'):
-    def check_quality(f):
+    def check_quality(f, speed):
         size = f.stat().st_size
         q, sampling_factor = get_jpeg_quality(f)
-        print(f'{bytes_to_kb(size)}, q{q}, {sampling_factor}')
+        print(f'{bytes_to_kb(size)} ({speed}), q{q}, {sampling_factor}')
         if q == 85 and sampling_factor == '2x2,1x1,1x1':
             return 'bad'
         if q > 85:
@@ -54,10 +56,10 @@ def get_orig(url, save_dir='.', test_mode=False, bad_file='delete'):
 
     web_name = get_webname(url)
     f = save_dir / web_name
-    download(url, f)
+    speed = download(url, f)
 
     print('    First try: ', end='')
-    old_quality = check_quality(f)
+    old_quality = check_quality(f, speed)
     if old_quality == 'good':
         f.rename(f.with_name(f'{f.stem}_orig.jpg'))
         print(f'    Find original. Stop.')
@@ -78,8 +80,8 @@ def get_orig(url, save_dir='.', test_mode=False, bad_file='delete'):
         else:
             print(f'    Got a different file: ', end='')
             savef = f.with_name(f'{f.stem}_orig.jpg')
-            download(r, savef)
-            new_quality = check_quality(savef)
+            speed = download(r, savef)
+            new_quality = check_quality(savef, speed)
             new_filesize = savef.stat().st_size
             if test_mode:
                 print(f'    Test mode. So keep both files.')
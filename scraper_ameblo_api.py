@@ -5,9 +5,11 @@ import concurrent.futures
 import json
 from dateutil import parser as dateparser
 
-from util import safeify, download, get, dump_json, parse_to_shortdate, requests_retry_session
+from util import safeify, download, get, dump_json, parse_to_shortdate, get_session, DownloadIndex, HttpCache, BlobStore, metrics
 
 
+# images are fetched by up to 10 entries x 10 threads at once.
+IMAGE_HOST_POOL_SIZES = {'stat.ameba.jp': 100}
 UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/122.0.0.0 Safari/537.36"
 headers = {'User-Agent': UA}
 
@@ -20,10 +22,11 @@ def load_init_data(soup):
 def first(my_dict):
     return list(my_dict.values())[0]
 
-def download_image(blog_id, id, save_folder='.'):
+def download_image(blog_id, id, save_folder='.', index=None, store=None):
     # print(f'Processing {id}...')
-    data = requests_retry_session().get(f'https://blogimgapi.ameba.jp/blog/{blog_id}/entries/{id}/images', headers=headers).json()
+    data = get_session().get(f'https://blogimgapi.ameba.jp/blog/{blog_id}/entries/{id}/images', headers=headers).json()
 
+    session = get_session(host_pool_sizes=IMAGE_HOST_POOL_SIZES)
     with concurrent.futures.ThreadPoolExecutor(max_workers=10) as ex:
         for idx, img in enumerate(data['data'], 1):
             img_url = urljoin('https://stat.ameba.jp/', img['imgUrl'])
@@ -37,7 +40,7 @@ def download_image(blog_id, id, save_folder='.'):
             desc = img['title']
             desc_ = f'{desc}_{idx}' if len(data['data']) > 1 else desc
             img_name = safeify(f'{img_date} ameblo_{blog_id}_{id} {desc_} {file_name}')
-            ex.submit(download, img_url, Path(save_folder) / img_name, dupe='skip', verbose=1, headers=headers)
+            ex.submit(download, img_url, Path(save_folder) / img_name, dupe='skip', verbose=1, headers=headers, session=session, index=index, store=store)
 
 def download_text(blog_id, id, save_folder='.'):
     # print(f'Processing {id}...')
@@ -77,7 +80,7 @@ def parse_image_list(blog_id, start_entry, until=None):
     results = []
     while True:
         print(f'Parsing {blog_id} starting from {start_entry}...')
-        data = requests_retry_session().get(f'https://blogimgapi.ameba.jp/blog/{blog_id}/entries/{start_entry}/neighbors?limit=100', headers=headers).json()
+        data = get_session().get(f'https://blogimgapi.ameba.jp/blog/{blog_id}/entries/{start_entry}/neighbors?limit=100', headers=headers).json()
         for entry in data['data']:
             id = entry["entryId"]
             if until and str(id) == str(until):
@@ -89,9 +92,9 @@ def parse_image_list(blog_id, start_entry, until=None):
         start_entry = re.search(r'/entries/(\d+)/', data['paging']['nextUrl'])[1]
 
 
-def parse_list(blog_id, theme_name=None, limit=10, until=None):
+def parse_list(blog_id, theme_name=None, limit=10, until=None, cache=None):
     try: # Get blog_num_id
-        soup = get(f'https://ameblo.jp/{blog_id}/', headers=headers)
+        soup = get(f'https://ameblo.jp/{blog_id}/', headers=headers, cache=cache)
         data = load_init_data(soup)
         blog_num_id = first(data['bloggerState']['bloggerMap'])['blog']
         endpoint = f'https://ameblo.jp/_api/blogEntries;blogId={blog_num_id};'
@@ -99,7 +102,7 @@ def parse_list(blog_id, theme_name=None, limit=10, until=None):
         if theme_name:
             # get themes
             first_theme_id = first(data['bloggerState']['blogMap']).get('moblog_theme_id', None) or first(data['entryState']['entryMap']).get('theme_id', None)
-            soup2 = get(f'https://ameblo.jp/{blog_id}/theme-{first_theme_id}.html', headers=headers)
+            soup2 = get(f'https://ameblo.jp/{blog_id}/theme-{first_theme_id}.html', headers=headers, cache=cache)
             data2 = load_init_data(soup2)
             themes = data2['themesState']['themeMap']
             theme_id_to_be_used = None
@@ -125,7 +128,10 @@ def parse_list(blog_id, theme_name=None, limit=10, until=None):
     while True:
         url = f'{endpoint}limit={limit};offset={offset}'
         print(f'Loading {url}...')
-        data = requests_retry_session().get(url, headers=headers).json()
+        if cache is not None:
+            data = cache.get_parsed(url, json.loads, parse_key='json', headers=headers)
+        else:
+            data = get_session().get(url, headers=headers).json()
 
         if theme_name:
             blogs = data['entryMap']
@@ -148,8 +154,8 @@ def parse_list(blog_id, theme_name=None, limit=10, until=None):
             return ids
 
 
-def download_all(blog_id, save_folder='.', theme_name=None, executor=None, until=None, limit=10, download_type='image'):
-    results = parse_list(blog_id, until=until, limit=limit, theme_name=theme_name)
+def download_all(blog_id, save_folder='.', theme_name=None, executor=None, until=None, limit=10, download_type='image', index=None, cache=None, store=None):
+    results = parse_list(blog_id, until=until, limit=limit, theme_name=theme_name, cache=cache)
     if not results:
         print('No new entry found.')
         return
@@ -160,7 +166,7 @@ def download_all(blog_id, save_folder='.', theme_name=None, executor=None, until
         shutdown_executor_inside = True
     for id in results:
         if download_type in ['all', 'image']:
-            executor.submit(download_image, blog_id, id, save_folder)
+            executor.submit(download_image, blog_id, id, save_folder, index, store)
         if download_type in ['all', 'text']:
             executor.submit(download_text, blog_id, id, save_folder)
     if shutdown_executor_inside:
@@ -176,7 +182,17 @@ if __name__ == '__main__':
     parser.add_argument('--output', '-o', help='folder to save images and texts (default: CWD/{blog_id})')
     parser.add_argument('--until', help='download until this entry id (non-inclusive)')
     parser.add_argument('--type', default='image', help='download type (image, text, all)')
+    parser.add_argument('--index', help='SQLite file to record downloaded images in, so they are skipped without checking the folder')
+    parser.add_argument('--cache', help='folder to cache list pages in, so unchanged pages are not downloaded again (conditional GET)')
+    parser.add_argument('--store', help='folder of a content-addressed store; identical images are kept once and hardlinked')
+    parser.add_argument('--metrics', help='save per-host HTTP metrics to this file at the end (.json, or .prom for Prometheus text format)')
 
     args = parser.parse_args()
     save_folder = args.output if args.output else args.blog_id
-    download_all(args.blog_id, save_folder=save_folder, theme_name=args.theme, until=args.until, limit=500, download_type=args.type)
\ No newline at end of file
+    index = DownloadIndex(args.index) if args.index else None
+    cache = HttpCache(args.cache) if args.cache else None
+    store = BlobStore(args.store) if args.store else None
+    download_all(args.blog_id, save_folder=save_folder, theme_name=args.theme, until=args.until, limit=500, download_type=args.type, index=index, cache=cache, store=store)
+    if args.metrics:
+        metrics.save(args.metrics)
+        metrics.report()
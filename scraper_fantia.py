@@ -8,7 +8,7 @@ from urllib.parse import urljoin
 # from natsort import natsorted
 from bs4 import BeautifulSoup
 
-from util import download, get_webname, requests_retry_session, safeify
+from util import download, get_webname, requests_retry_session, safeify, profiler
 
 API_POSTS = "https://fantia.jp/api/v1/posts/{}"
 API_FANCLUB = "https://fantia.jp/api/v1/fanclubs/{}"
@@ -27,7 +27,7 @@ DEFAULT_FILENAME_TEMPLATE = '{content_id}{idx} {stem_cleaned}'
 
 
 class FantiaDownloader:
-    def __init__(self, key, fanclub=None, output='.', dir_template=None, filename_template=None, skip_existing=True, quick_stop=True):
+    def __init__(self, key, fanclub=None, output='.', dir_template=None, filename_template=None, skip_existing=True, quick_stop=True, index=None, cache=None, store=None):
         super().__init__()
         self.key = key
         self.fanclub = fanclub
@@ -39,6 +39,12 @@ class FantiaDownloader:
         self.skip_existing = skip_existing
         self.quick_stop = skip_existing and quick_stop
         self.fanclub_info = None
+        # optional util.DownloadIndex; used to skip downloaded files and posts without scanning the output folder.
+        self.index = index
+        # optional util.BlobStore; identical files (across posts and filename templates) are stored once.
+        self.store = store
+        # optional util.HttpCache for the post list pages.
+        self.cache = cache
 
         self.session = requests_retry_session()
         self.session.headers['User-Agent'] = DEFAULT_UA
@@ -80,18 +86,17 @@ class FantiaDownloader:
         base_dir = self.output / '/'.join(base_parts) if base_parts else self.output
 
         print(f'Fanclub {self.fanclub}: download all to {base_dir}.')
-        existing_ids = []
+        existing_ids = set()
+        # Either subdirectories (new structure) or files (old flat structure) starting with post_id
+        if self.index is not None:
+            for name in self.index.children(base_dir):
+                if m := re.match(r'^(\d+)\b', name):
+                    existing_ids.add(int(m.group(1)))
+        # the index only knows what's downloaded with it, so always add what's in the folder too.
         if base_dir.exists():
-            # Check for subdirectories starting with post_id (new structure)
             for f in base_dir.iterdir():
-                if f.is_dir() and (m := re.match(r'^(\d+)\b', f.name)):
-                    existing_ids.append(m.group(1))
-            # Also check for files starting with post_id (old flat structure)
-            for f in base_dir.iterdir():
-                if f.is_file() and (m := re.match(r'^(\d+)\b', f.name)):
-                    existing_ids.append(m.group(1))
-            existing_ids = list(dict.fromkeys(existing_ids))
-            existing_ids = set(map(int, existing_ids))
+                if m := re.match(r'^(\d+)\b', f.name):
+                    existing_ids.add(int(m.group(1)))
 
         print(f'{len(existing_ids)} ID(s) have already been downloaded.')
 
@@ -133,9 +138,13 @@ class FantiaDownloader:
 
     def fetch_gallery_page(self, page):
         url = HTML_POSTLIST.format(self.fanclub, page)
-        r = self.fetch(url)
-        r.encoding = 'utf-8'
-        html = r.text
+        if self.cache is not None:
+            content, _, _ = self.cache.fetch(url, session=self.session)
+            html = content.decode('utf-8', errors='replace')
+        else:
+            r = self.fetch(url)
+            r.encoding = 'utf-8'
+            html = r.text
         return sorted(map(int, re.findall(r'\/posts\/(?P<id>[0-9]{1,8})"', html)), reverse=True)
 
     def update_fanclub_info(self, d):
@@ -188,6 +197,7 @@ class FantiaDownloader:
         filename_without_ext = self.filename_template.format(**subs).strip()
         return f'{filename_without_ext}.{ext}'
 
+    @profiler.profile()
     def get_post_photos(self, id):
         print(f'Fetching post {id}...')
         while True:
@@ -218,7 +228,7 @@ class FantiaDownloader:
                 img_url = thumb['original']
                 stem, ext = get_webname(img_url).rsplit('.', 1)
                 cover_filename = f'!cover.{ext}'
-                ex.submit(download, img_url, filename=output_dir / cover_filename, verbose=1)
+                ex.submit(download, img_url, filename=output_dir / cover_filename, verbose=1, index=self.index, store=self.store)
             if post_contents := post_data.get('post_contents', None):
                 for c in post_contents:
                     cid = c['id']
@@ -232,12 +242,12 @@ class FantiaDownloader:
                             stem_cleaned = stem_cleaned.strip()
                             idx_string = '_' + str(idx).zfill(len(str(len(photos)))) if len(photos) > 1 else ''
                             filename = self._format_filename(post_subs, cid, idx_string, stem_cleaned, ext)
-                            ex.submit(download, img_url, filename=output_dir / filename, verbose=1)
+                            ex.submit(download, img_url, filename=output_dir / filename, verbose=1, index=self.index, store=self.store)
                     if 'download_uri' in c:
                         dl_url = urljoin('https://fantia.jp', c['download_uri'])
                         # For download files, use original filename with content_id prefix
                         dl_filename = f'{cid} {c["filename"]}'
-                        ex.submit(download, dl_url, filename=output_dir / dl_filename, session=self.session, verbose=1)
+                        ex.submit(download, dl_url, filename=output_dir / dl_filename, session=self.session, verbose=1, connections=4, index=self.index, store=self.store)
 
 if __name__ == "__main__":
     pass
@@ -2,10 +2,9 @@ from urllib.parse import urlparse, parse_qs
 import requests
 import re
 from pathlib import Path
-import concurrent.futures
 import requests
 from subprocess import run, DEVNULL
-from util import download
+from util import download_batch
 
 class RadikoExtractor():
     def __init__(self, url, save_dir='.', *args, **kwargs):
@@ -154,9 +153,7 @@ class RadikoExtractor():
             temp_folder.mkdir(parents=True)
 
             print(f'Download video {filename} segs from\n{m3u8_url}')
-            with concurrent.futures.ThreadPoolExecutor(max_workers=10) as e:
-                for url in urls:
-                    e.submit(download, url, save_path=temp_folder)
+            download_batch([(url, None) for url in urls], save_path=temp_folder, max_concurrency=10)
 
             files = [f for f in temp_folder.iterdir() if f.suffix.lower() == '.aac']
             # Since FFMPEG 4.4, "the file names / paths given in the concat file are relative to the position of the concat file"
@@ -0,0 +1,33 @@
+'''
+util.BlobStore.add with the same content added concurrently.
+
+usage: python -m pytest tests
+'''
+import sys
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import util
+
+
+def test_concurrent_add_of_the_same_content(tmp_path):
+    store = util.BlobStore(tmp_path / 'store')
+    digest = 'ab' * 64
+    results = []
+
+    def add(i):
+        f = tmp_path / f'{i}.part'
+        f.write_bytes(b'same content')
+        results.append(store.add(f, digest, tmp_path / 'out' / f'{i}.bin'))
+
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results.count(True) == 1
+    assert sorted(p.name for p in store.root.rglob('*') if p.is_file()) == [digest]
+    assert not list(tmp_path.glob('*.part'))
+    assert all(f.read_bytes() == b'same content' for f in (tmp_path / 'out').iterdir())
+    assert len(list((tmp_path / 'out').iterdir())) == 20
@@ -0,0 +1,126 @@
+'''
+The connection limits of util.HostLimiter shared by threads and asyncio tasks.
+
+usage: python -m pytest tests
+'''
+import asyncio
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import util
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(0.05)
+        body = self.path.encode() * 100
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def host_limit():
+    def set_limit(host, connections):
+        util.set_host_limit(host, connections=connections)
+        hosts.append(host)
+    hosts = []
+    yield set_limit
+    for host in hosts:
+        util.set_host_limit(host)
+
+
+@pytest.mark.parametrize('connections', [1, 8])
+def test_download_batch_with_hostname_and_limit(tmp_path, server, host_limit, connections):
+    # waiting for a slot must not block the threads aiohttp resolves "localhost" with.
+    pytest.importorskip('aiohttp')
+    host_limit('localhost', connections)
+    jobs = [(f'http://localhost:{server}/{i}.bin', None) for i in range(30)]
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(statuses=util.download_batch(jobs, save_path=tmp_path, verbose=0)), daemon=True)
+    thread.start()
+    thread.join(timeout=30)
+    assert not thread.is_alive(), 'download_batch hangs'
+    assert result['statuses'] == [200] * 30
+    assert len(list(tmp_path.iterdir())) == 30
+
+
+def test_slots_shared_by_threads_and_tasks(host_limit):
+    host_limit('shared.test', 2)
+    limiter = util.host_limiter('http://shared.test/')
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def hold():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.pop()
+
+    def in_thread():
+        for _ in range(5):
+            with limiter.slot():
+                hold()
+
+    async def in_tasks():
+        async def task():
+            slot = await limiter.aslot_acquire()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, hold)
+            finally:
+                slot.release()
+        await asyncio.gather(*(task() for _ in range(10)))
+
+    threads = [threading.Thread(target=in_thread) for _ in range(3)]
+    for t in threads:
+        t.start()
+    asyncio.run(in_tasks())
+    for t in threads:
+        t.join()
+    assert max(peak) == 2
+    assert limiter._semaphore._value == 2
+
+
+def test_cancelled_waiter_gives_the_slot_back(host_limit):
+    host_limit('cancel.test', 1)
+    limiter = util.host_limiter('http://cancel.test/')
+
+    async def main():
+        slot = await limiter.aslot_acquire()
+        waiter = asyncio.create_task(limiter.aslot_acquire())
+        await asyncio.sleep(0.01)
+        # the slot is handed to the waiter, which is cancelled before it runs.
+        slot.release()
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        await asyncio.sleep(0.01)
+        slot = await asyncio.wait_for(limiter.aslot_acquire(), timeout=1)
+        slot.release()
+
+    asyncio.run(main())
+    assert limiter._semaphore._value == 1
@@ -0,0 +1,34 @@
+'''
+util.tic/tac timers: repeated tic()s replace the running timer instead of stacking.
+
+usage: python -m pytest tests
+'''
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import util
+
+
+def names():
+    return [timer[0] for timer in util._tic_local.starts]
+
+
+def test_repeated_tic_does_not_grow():
+    for _ in range(100):
+        util.tic()
+        util.tac(print=False)
+    assert names() == ['tic-tac']
+
+
+def test_nested_tic():
+    util.tic('outer')
+    util.tic('inner')
+    assert names()[-2:] == ['outer', 'inner']
+    util.tac(print=False, stop=True)
+    assert names()[-1] == 'outer'
+    util.tic('inner')
+    # restarting the outer timer ends the inner one.
+    util.tic('outer')
+    assert names()[-1] == 'outer' and 'inner' not in names()
+    util.tac(print=False, stop=True)
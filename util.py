@@ -1,14 +1,18 @@
 import builtins
+import collections
 import json
 import os
 import re
 import sys
+import threading
 import time
 import hashlib
 import shutil
 import unicodedata
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
+from typing import NamedTuple, Optional
 from urllib.parse import unquote
 
 # all the external dependencies are imported inside the functions,
@@ -540,24 +544,220 @@ def to_jp_time(dt, input_timezone=None):
     return dt.astimezone(timezone('asia/tokyo'))
 
 # ==================== performance related ====================
-def tic():
-    global _start_time
-    _start_time = time.time()
+class _Span:
+    def __init__(self, profiler, name, cprofile=False, memory=False):
+        self.profiler = profiler
+        self.name = name
+        self.cprofile = cprofile
+        self.memory = memory
+        self._prof = None
+        self._peak = 0
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        self.parent = stack[-1] if stack else None
+        self.path = f'{self.parent.path} > {self.name}' if self.parent else self.name
+        stack.append(self)
+        if self.memory:
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self._mem_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        if self.cprofile:
+            import cProfile
+            prof = cProfile.Profile()
+            try:
+                prof.enable()
+                self._prof = prof
+            except ValueError: # another profiler is active (e.g. a parent span's)
+                pass
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter_ns() - self._start
+        if self._prof:
+            self._prof.disable()
+        mem = None
+        if self.memory:
+            import tracemalloc
+            current, peak = tracemalloc.get_traced_memory()
+            # a child span resets the peak, so take the max with what they've seen.
+            peak = max(peak, self._peak)
+            if self.parent is not None and self.parent.memory:
+                self.parent._peak = max(self.parent._peak, peak)
+            mem = (current - self._mem_start, peak - self._mem_start)
+        self.profiler._stack().pop()
+        self.profiler._record(self.path, elapsed, mem=mem, prof=self._prof)
+        return False
+
+class Profiler:
+    """
+    Nested, thread-aware timing spans with aggregated reports.
+
+    Each thread has its own span stack, so spans nest per thread ("download_video > _download"), and the same span path
+    from many threads is aggregated (count, total, mean, min, max). Optionally, a span can also be run under cProfile,
+    and/or track its memory with tracemalloc (net allocated and peak). Note tracemalloc is process-wide, so the memory
+    numbers include other threads running at the same time.
+
+    Example usage:
+        with profiler.span('parse'):
+            ...
+
+        @profiler.profile(cprofile=True)
+        def download_video(self): ...
+
+        profiler.report()
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+            self._pstats = {}
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _record(self, path, elapsed_ns, mem=None, prof=None):
+        with self._lock:
+            st = self._stats.get(path)
+            if st is None:
+                st = self._stats[path] = {'count': 0, 'total_ns': 0, 'min_ns': elapsed_ns, 'max_ns': 0, 'threads': set(),
+                                          'mem_net': 0, 'mem_peak': 0}
+            st['count'] += 1
+            st['total_ns'] += elapsed_ns
+            st['min_ns'] = min(st['min_ns'], elapsed_ns)
+            st['max_ns'] = max(st['max_ns'], elapsed_ns)
+            st['threads'].add(threading.get_ident())
+            if mem:
+                st['mem_net'] += mem[0]
+                st['mem_peak'] = max(st['mem_peak'], mem[1])
+            if prof is not None:
+                import pstats
+                if path in self._pstats:
+                    self._pstats[path].add(prof)
+                else:
+                    self._pstats[path] = pstats.Stats(prof)
+
+    def span(self, name, cprofile=False, memory=False):
+        '''
+        A context manager timing its block as a span named name (nested in the current span of this thread, if any).
+        cprofile: also run it under cProfile (only if no other profiler is active). memory: also trace its memory.
+        '''
+        return _Span(self, name, cprofile=cprofile, memory=memory)
+
+    def profile(self, name=None, cprofile=False, memory=False):
+        '''A decorator running the function in a span (named after the function by default).'''
+        import functools
+
+        def decorator(func):
+            span_name = name or func.__qualname__
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name, cprofile=cprofile, memory=memory):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add(self, name, seconds):
+        '''Record a measured duration as a span (nested in the current span of this thread, if any).'''
+        stack = self._stack()
+        self._record(f'{stack[-1].path} > {name}' if stack else name, int(seconds * 1e9))
+
+    def to_dict(self):
+        '''{span path: {count, total, mean, min, max (seconds), threads, mem_net, mem_peak (bytes)}}'''
+        with self._lock:
+            return {path: {'count': st['count'],
+                           'total': st['total_ns'] / 1e9,
+                           'mean': st['total_ns'] / st['count'] / 1e9,
+                           'min': st['min_ns'] / 1e9,
+                           'max': st['max_ns'] / 1e9,
+                           'threads': len(st['threads']),
+                           'mem_net': st['mem_net'],
+                           'mem_peak': st['mem_peak']}
+                    for path, st in sorted(self._stats.items())}
+
+    def report(self, sort='path', top=10):
+        '''
+        Print the aggregated spans (sort by 'path', 'total', 'mean' or 'count'), and the top cProfile functions of the cProfile'd ones.
+        '''
+        data = self.to_dict()
+        paths = sorted(data, key=lambda p: p if sort == 'path' else -data[p][sort])
+        print(f'{"span":<50} {"count":>7} {"total s":>10} {"mean ms":>10} {"min ms":>10} {"max ms":>10} {"thr":>4}  memory')
+        for path in paths:
+            d = data[path]
+            label = '  ' * path.count(' > ') + path.rsplit(' > ', 1)[-1] if sort == 'path' else path
+            mem = f'net {d["mem_net"] / 1024 / 1024:.2f} MB, peak {d["mem_peak"] / 1024 / 1024:.2f} MB' if d['mem_peak'] else ''
+            print(f'{label[:50]:<50} {d["count"]:>7} {d["total"]:>10.3f} {d["mean"] * 1000:>10.2f} {d["min"] * 1000:>10.2f} {d["max"] * 1000:>10.2f} {d["threads"]:>4}  {mem}')
+        with self._lock:
+            pstats_items = list(self._pstats.items())
+        for path, stats in pstats_items:
+            print(f'\n===== cProfile: {path} =====')
+            stats.sort_stats('cumulative').print_stats(top)
+
+profiler = Profiler()
+
+def tic(name='tic-tac'):
+    '''
+    Start a timer; tac() reads the latest one (per thread, so they can be used in threads).
+    Timers with different names nest; a tic() with the name of a running timer restarts it (and drops the ones nested in it),
+    so calling tic() again, e.g. in a loop, doesn't pile up timers.
+    '''
+    global _last_tic
+    if not hasattr(_tic_local, 'starts'):
+        _tic_local.starts = []
+    starts = _tic_local.starts
+    for i, timer in enumerate(starts):
+        if timer[0] == name:
+            del starts[i:]
+            break
+    now = time.perf_counter_ns()
+    # [name, start, last lap]
+    _last_tic = [name, now, now]
+    starts.append(_last_tic)
 
-def tac(print=True):
-    global _start_time
-    t = time.time() - _start_time
+def tac(print=True, stop=False):
+    '''
+    Return the seconds passed since the latest tic() of this thread (or, if this thread has none, the latest tic() of any thread).
+    It can be called many times for laps (reading the timer, not adding one); pass stop=True to also remove the timer,
+    e.g. to end a nested tic().
+    The time since the previous tac() (the lap) is recorded in `profiler`.
+    '''
+    starts = getattr(_tic_local, 'starts', None)
+    timer = starts[-1] if starts else _last_tic
+    if timer is None:
+        raise RuntimeError('tac() is called without tic().')
+    if stop and starts:
+        starts.pop()
+    name, start, lap = timer
+    now = time.perf_counter_ns()
+    timer[2] = now
+    profiler.add(name, (now - lap) / 1e9)
+    t = (now - start) / 1e9
     if print:
         builtins.print(f'Time passed: {t:.2f} s')
     return t
 
+_tic_local = threading.local()
+_last_tic = None
+
 # a decorator to time a function
 def timeme(func):
+    import functools
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        print(f"{func.__name__} executed in {end_time - start_time:.02f} seconds")
+        start = time.perf_counter_ns()
+        with profiler.span(func.__qualname__):
+            result = func(*args, **kwargs)
+        print(f"{func.__name__} executed in {(time.perf_counter_ns() - start) / 1e9:.02f} seconds")
         return result
     return wrapper
 
@@ -627,28 +827,66 @@ def dump_tsv(data, filename='temp.tsv', verbose=True, print_header=False):
     filename.write_text(s, encoding='utf8')
 
 
-def get_files(directory, recursive=False, file_filter=None, path_filter=None):
-    '''filter(s): true means include, false means exclude'''
+def iter_files(directory, recursive=False, file_filter=None, path_filter=None, workers=1):
+    '''
+    Walk a folder with os.scandir and yield its files as os.DirEntry objects, as they're found.
+
+    filter(s): true means include, false means exclude. They're called with DirEntry objects, which have name, path,
+    is_file()/is_dir() and stat() cached from the directory listing (on Windows even stat() needs no extra syscall),
+    so filtering costs (almost) nothing compared to the scan itself.
+    path_filter decides whether to go into a subfolder (only matters when recursive).
+
+    With workers > 1, folders are scanned in a thread pool (the order of the results is not stable then),
+    which is much faster for big trees, especially on network shares.
+    '''
+    def scan(directory):
+        files, subdirs = [], []
+        try:
+            it = os.scandir(directory)
+        except PermissionError as e:
+            print('Error:', e)
+            return files, subdirs
+        with it:
+            for entry in it:
+                if entry.is_file():
+                    if not file_filter or file_filter(entry):
+                        files.append(entry)
+                elif recursive and entry.is_dir(follow_symlinks=False) and (not path_filter or path_filter(entry)):
+                    subdirs.append(entry.path)
+        return files, subdirs
+
+    if workers <= 1:
+        stack = [os.fspath(directory)]
+        while stack:
+            files, subdirs = scan(stack.pop())
+            yield from files
+            stack.extend(reversed(subdirs))
+        return
+
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    ex = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = {ex.submit(scan, os.fspath(directory))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                pending.update(ex.submit(scan, d) for d in subdirs)
+                yield from files
+    finally:
+        # also when the caller stops early.
+        ex.shutdown(wait=False, cancel_futures=True)
+
+def get_files(directory, recursive=False, file_filter=None, path_filter=None, workers=1):
+    '''
+    filter(s): true means include, false means exclude. They're called with Path objects (use iter_files() for DirEntry ones).
+    Either way the folder is walked with os.scandir, so no extra stat is done for the is_file()/is_dir() checks.
+    '''
     directory = Path(directory)
     assert(directory.is_dir())
-    # if there is no filter, use os.scandir generator, since it is so much faster.
-    if file_filter is None and path_filter is None:
-        def quick_scan(directory):
-            for entry in os.scandir(directory):
-                if entry.is_file():
-                    yield entry
-                elif recursive and entry.is_dir(follow_symlinks=False):
-                    yield from quick_scan(entry.path)
-        return [Path(f) for f in quick_scan(directory)]
-    # else, use pathlib.iterdir and just dynamically change the list. The speed is basically the same (slow).
-    file_list = []
-    for x in directory.iterdir():
-        if x.is_file():
-            if not file_filter or file_filter(x):
-                file_list.append(x)
-        elif recursive and x.is_dir() and (not path_filter or path_filter(x)):
-            file_list.extend(get_files(x, recursive=recursive, file_filter=file_filter, path_filter=path_filter))
-    return file_list
+    return [Path(entry.path) for entry in iter_files(directory, recursive=recursive, workers=workers,
+                                                     file_filter=file_filter and (lambda entry: file_filter(Path(entry.path))),
+                                                     path_filter=path_filter and (lambda entry: path_filter(Path(entry.path))))]
 
 def remove_empty_folders(directory, remove_root=True): #Including root.
     directory = Path(directory)
@@ -710,6 +948,27 @@ def quickmd5(f):
 
     return f"{file_size}_{hasher.hexdigest()}" # this way is more readable than just return the hexdigest.
 
+def new_hasher(algo='blake2b'):
+    '''
+    Create an incremental hasher (with update() and hexdigest()) by name: any hashlib algorithm (e.g. 'blake2b', 'sha256', 'md5'),
+    or 'xxh64'/'xxh3_64'/'xxh3_128'/'xxh128' if xxhash is installed (much faster, but not cryptographic).
+    '''
+    if algo.startswith('xxh'):
+        # pip install xxhash
+        import xxhash
+        return getattr(xxhash, algo)()
+    return hashlib.new(algo)
+
+def hash_file(f, algo='blake2b', buffer_size=4*1024*1024):
+    '''Full-content hash of a file, formatted as "{algo}:{hexdigest}" (same as the one download() computes while downloading).'''
+    hasher = new_hasher(algo)
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with Path(f).open('rb', buffering=0) as fio:
+        while n := fio.readinto(buffer):
+            hasher.update(view[:n])
+    return f'{algo}:{hasher.hexdigest()}'
+
 def move_or_delete_duplicate(src, dst, verbose=True, conflict='error', hash_method=quickmd5):
     """
     Move a file, or delete it if the same file already exists at the destination.
@@ -735,7 +994,8 @@ def move_or_delete_duplicate(src, dst, verbose=True, conflict='error', hash_meth
     if src == dst:
         raise ValueError(f"Source and destination are the same: {src}")
     if dst.exists():
-        if hash_method(src) == hash_method(dst):
+        # files with different sizes can't be the same, no matter the hash method; don't bother reading them.
+        if src.stat().st_size == dst.stat().st_size and hash_method(src) == hash_method(dst):
             print(f'[W] {src.name} is a duplicate. Remove.')
             src.unlink()
             return
@@ -758,18 +1018,346 @@ def move_or_delete_duplicate(src, dst, verbose=True, conflict='error', hash_meth
             print(f'Move {src.name} to {dst}')
     shutil.move(src, dst)
 
-def batch_rename(renamings):
+class HashCache:
+    """
+    An on-disk (SQLite) cache of file hashes keyed by (path, size, mtime), used by find_duplicates().
+    A file is only hashed again when its size or mtime changed, so re-scanning a big tree is mostly lookups.
+
+    Args:
+        db_file (str): The SQLite file. Created if it doesn't exist.
+    """
+    def __init__(self, db_file):
+        import sqlite3
+
+        self.db_file = Path(db_file)
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._pending = 0
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS hashes (path TEXT, kind TEXT, size INTEGER, mtime INTEGER, hash TEXT, PRIMARY KEY (path, kind))')
+
+    def get(self, path, kind, size, mtime):
+        '''Return the cached hash of kind (e.g. 'quickmd5' or 'blake2b'), or None if it's not cached or the file has changed.'''
+        with self._lock:
+            row = self._conn.execute('SELECT hash FROM hashes WHERE path = ? AND kind = ? AND size = ? AND mtime = ?',
+                                     (os.path.abspath(path), kind, size, mtime)).fetchone()
+        return row[0] if row else None
+
+    def set(self, path, kind, size, mtime, hash):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO hashes (path, kind, size, mtime, hash) VALUES (?, ?, ?, ?, ?)',
+                               (os.path.abspath(path), kind, size, mtime, hash))
+            # commit in batches; one transaction per file is way too slow for big trees.
+            self._pending += 1
+            if self._pending >= 1000:
+                self._conn.commit()
+                self._pending = 0
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        self.commit()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def find_duplicates(directories, recursive=True, file_filter=None, path_filter=None, algo='blake2b', cache=None, workers=8, min_size=1, verbose=True):
+    """
+    Find duplicate files in one or more folders.
+
+    Files are grouped by size first, then by quickmd5 (first and last 1MB), and only the files that still collide are fully hashed.
+    Hashing runs in a thread pool, and with a HashCache the hashes are reused until a file's size or mtime changes.
+    Hardlinks of the same file are counted only once (they don't take extra space).
+
+    Args:
+        directories (str or list): The folder(s) to scan.
+        recursive (bool, optional): Whether to scan subfolders. Defaults to True.
+        file_filter, path_filter (function, optional): Same as iter_files() (called with os.DirEntry objects).
+        algo (str, optional): The algorithm of the full hash (see new_hasher()). Defaults to 'blake2b'.
+        cache (HashCache or str, optional): A HashCache (or its db file) to cache the hashes in. Defaults to None.
+        workers (int, optional): The number of hashing threads. Defaults to 8.
+        min_size (int, optional): Ignore files smaller than this. Defaults to 1 (ignore empty files).
+        verbose (bool, optional): Whether to print the progress. Defaults to True.
+
+    Returns:
+        list: A list of groups (lists of Paths, sorted) of identical files, largest files first.
+    """
+    # a cache opened here (from a db file) is also closed here, so the db isn't left locked.
+    own_cache = isinstance(cache, (str, Path))
+    if own_cache:
+        cache = HashCache(cache)
+    try:
+        return _find_duplicates(directories, recursive, file_filter, path_filter, algo, cache, workers, min_size, verbose)
+    finally:
+        if own_cache:
+            cache.close()
+
+def _find_duplicates(directories, recursive, file_filter, path_filter, algo, cache, workers, min_size, verbose):
+    from concurrent.futures import ThreadPoolExecutor
+
+    stats = {}
+    def stat(entry):
+        # cached from the directory listing on Windows; otherwise at least it's done in parallel.
+        return Path(entry.path), entry.stat()
+    entries = [entry for directory in to_list(directories)
+               for entry in iter_files(directory, recursive=recursive, file_filter=file_filter, path_filter=path_filter, workers=workers)]
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        seen_inodes = set()
+        for f, st in ex.map(stat, entries):
+            if st.st_size < min_size or (st.st_dev, st.st_ino) in seen_inodes:
+                continue
+            if st.st_ino: # 0 if the filesystem doesn't have inode numbers
+                seen_inodes.add((st.st_dev, st.st_ino))
+            stats[f] = st
+    if verbose:
+        print(f'[I] Found {len(stats)} files.')
+
+    def cached_hash(f, kind, func):
+        st = stats[f]
+        if cache is not None and (h := cache.get(f, kind, st.st_size, st.st_mtime_ns)):
+            return h
+        h = func(f)
+        if cache is not None:
+            cache.set(f, kind, st.st_size, st.st_mtime_ns, h)
+        return h
+
+    def regroup(groups, kind, func):
+        '''Split each group by the hash of kind; keep the (sub)groups with more than one file.'''
+        todo = [f for group in groups for f in group]
+        if verbose and todo:
+            print(f'[I] Hashing {len(todo)} files ({kind})...')
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            hashes = dict(zip(todo, ex.map(lambda f: cached_hash(f, kind, func), todo)))
+        new_groups = []
+        for group in groups:
+            by_hash = {}
+            for f in group:
+                by_hash.setdefault(hashes[f], []).append(f)
+            new_groups.extend(g for g in by_hash.values() if len(g) > 1)
+        return new_groups
+
+    by_size = {}
+    for f, st in stats.items():
+        by_size.setdefault(st.st_size, []).append(f)
+    groups = [g for g in by_size.values() if len(g) > 1]
+    try:
+        groups = regroup(groups, 'quickmd5', quickmd5)
+        # quickmd5 reads the first and last 1MB, which is the whole file if it's <= 2MB. So only bigger ones need a full hash.
+        small = [g for g in groups if stats[g[0]].st_size <= 2 * 1024 * 1024]
+        big = [g for g in groups if stats[g[0]].st_size > 2 * 1024 * 1024]
+        groups = small + regroup(big, algo, lambda f: hash_file(f, algo))
+    finally:
+        if cache is not None:
+            cache.commit()
+    groups = [sorted(g) for g in groups]
+    groups.sort(key=lambda g: (-stats[g[0]].st_size, g[0]))
+    return groups
+
+def dedupe(directories, action='print', keep=None, recursive=True, file_filter=None, path_filter=None, algo='blake2b', cache=None, workers=8, min_size=1, verbose=True):
+    """
+    Find duplicate files (see find_duplicates()) and delete (or hardlink) all but one of each group.
+
+    Args:
+        directories (str or list): The folder(s) to scan.
+        action (str, optional): 'print' (only list them), 'delete', or 'link' (replace the duplicates with hardlinks
+            to the kept file, so the paths stay). Defaults to 'print'.
+        keep (function, optional): Choose the file to keep from a group. Defaults to the one with the shortest name
+            (so "file.jpg" over "file_2.jpg"), then path.
+        recursive, file_filter, path_filter, algo, cache, workers, min_size, verbose: Passed to find_duplicates().
+
+    Returns:
+        list: The groups of duplicates, as find_duplicates().
+    """
+    assert action in ['print', 'delete', 'link'], f'Unknown action: {action}'
+    keep = keep or (lambda group: min(group, key=lambda f: (len(f.name), str(f))))
+    groups = find_duplicates(directories, recursive=recursive, file_filter=file_filter, path_filter=path_filter, algo=algo,
+                             cache=cache, workers=workers, min_size=min_size, verbose=verbose)
+    saved = 0
+    for group in groups:
+        kept = keep(group)
+        print(f'{kept}')
+        for f in group:
+            if f == kept:
+                continue
+            saved += f.stat().st_size
+            if action == 'print':
+                print(f'  = {f}')
+            elif action == 'delete':
+                print(f'  - {f}')
+                f.unlink()
+            elif action == 'link':
+                print(f'  > {f}')
+                temp_f = ensure_nonexist(f.with_name(f.stem + '_temp' + f.suffix))
+                os.link(kept, temp_f)
+                os.replace(temp_f, f)
+    print(f'[I] {len(groups)} groups of duplicates, {saved / 1024 / 1024:.2f} MB {"can be" if action == "print" else "is"} saved.')
+    return groups
+
+def _plan_renames(renamings, verbose=True):
+    '''
+    Check the renamings for conflicts and turn them into a plan: a list of (src, dst) steps, with temporary renames first
+    for the files that are also the destination of another one (chains/swaps). Returns None if there is a conflict.
+    '''
+    files = [Path(f) for f, _ in renamings]
+    dst_files = [f.with_name(name) for f, (_, name) in zip(files, renamings)]
+    file_set = set(files)
+    dst_set = set(dst_files)
+
+    if len(file_set) != len(files):
+        print('[E] There are duplicate files in the list! Please check.')
+        return None
+
+    if len(dst_set) != len(dst_files):
+        print('[E] There are duplicate new filenames in the list! Please check.')
+        return None
+
+    # if new filename is conflicting and not in our current files, abort
+    for new_f in dst_files:
+        if new_f not in file_set and new_f.exists():
+            print(f'[E] file {new_f.name} already exists. Please rename it first.')
+            return None
+
+    # rename current file(s) to temp filename to make renaming possible
+    temp_steps, steps = [], []
+    taken = file_set | dst_set
+    for f, dst in zip(files, dst_files):
+        if f == dst:
+            continue
+        if f in dst_set:
+            temp_f = f.with_name(f'{f.stem}_temp{f.suffix}')
+            i = 2
+            while temp_f in taken or temp_f.exists():
+                temp_f = f.with_name(f'{f.stem}_temp_{i}{f.suffix}')
+                i += 1
+            taken.add(temp_f)
+            if verbose:
+                print(f'[I] temporarily rename {f.name} to {temp_f.name}')
+            temp_steps.append((f, temp_f))
+            f = temp_f
+        steps.append((f, dst))
+    return temp_steps + steps
+
+def _steps_by_folder(plan):
+    # all the renames are within a folder, so folders are independent of each other.
+    by_folder = {}
+    for i, (src, _) in enumerate(plan):
+        by_folder.setdefault(src.parent, []).append(i)
+    return by_folder
+
+def _load_rename_journal(journal):
+    '''Read a batch_rename() journal and return (plan, done): the steps, and the indices of the steps that have been done.'''
+    lines = Path(journal).read_text(encoding='utf-8').splitlines()
+    plan = [(Path(src), Path(dst)) for src, dst in json.loads(lines[0])['plan']]
+    done = set()
+    for line in lines[1:]:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError: # torn last line from a crash
+            break
+        if 'done' in entry:
+            done.add(entry['done'])
+        elif 'undone' in entry:
+            done.discard(entry['undone'])
+    # steps in a folder are done in order, so only the first one not recorded yet could have been done (right before a crash).
+    for steps in _steps_by_folder(plan).values():
+        for i in steps:
+            if i not in done:
+                src, dst = plan[i]
+                if not src.exists() and dst.exists():
+                    done.add(i)
+                break
+    return plan, done
+
+def _run_rename_plan(plan, journal=None, done=None, workers=1):
+    '''Do the steps of plan not in done (folders in parallel), recording them in the journal. Roll back everything if a step fails.'''
+    from concurrent.futures import ThreadPoolExecutor
+
+    done = set(done or ())
+    lock = threading.Lock()
+    failed = threading.Event()
+    errors = []
+    fio = open(journal, 'a', encoding='utf-8') if journal else None
+
+    def run_folder(steps):
+        for i in steps:
+            if failed.is_set():
+                return
+            if i in done:
+                continue
+            src, dst = plan[i]
+            try:
+                src.rename(dst)
+            except OSError as e:
+                errors.append(e)
+                failed.set()
+                return
+            with lock:
+                done.add(i)
+                if fio:
+                    fio.write(json.dumps({'done': i}) + '\n')
+                    fio.flush()
+
+    by_folder = _steps_by_folder(plan)
+    try:
+        if workers <= 1 or len(by_folder) == 1:
+            for steps in by_folder.values():
+                run_folder(steps)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                list(ex.map(run_folder, by_folder.values()))
+    finally:
+        if fio:
+            fio.close()
+    if errors:
+        print(f'[E] Renaming failed: {errors[0]}. Rolling back {len(done)} renamed file(s)...')
+        _rollback_rename_plan(plan, done, journal)
+        raise errors[0]
+    if journal:
+        Path(journal).unlink()
+
+def _rollback_rename_plan(plan, done, journal=None):
+    fio = open(journal, 'a', encoding='utf-8') if journal else None
+    try:
+        for i in sorted(done, reverse=True):
+            src, dst = plan[i]
+            if dst.exists(): # otherwise it's been undone already (right before a crash)
+                dst.rename(src)
+            if fio:
+                fio.write(json.dumps({'undone': i}) + '\n')
+                fio.flush()
+    finally:
+        if fio:
+            fio.close()
+    if journal:
+        Path(journal).unlink()
+
+def batch_rename(renamings, journal=None, workers=1, verbose=True):
     """
     Batch rename files without conflicts.
 
     Args:
         renamings (list): A list of tuples containing the original file paths and the new names.
+        journal (str, optional): A file to log the planned renames (before doing anything) and the progress in.
+            If it's interrupted (crash, power loss...), use resume_batch_rename() or rollback_batch_rename() with it.
+            Deleted when it's finished. Defaults to None (no journal).
+        workers (int, optional): Rename files in this many folders in parallel. Defaults to 1.
+        verbose (bool, optional): Whether to print the temporary renames. Defaults to True.
 
     Returns:
         None
 
     Raises:
-        None
+        OSError: If a rename fails. The files renamed so far are renamed back first.
 
     This function renames multiple files simultaneously without causing conflicts. It checks for duplicate files
     in the list, duplicate new filenames, and conflicts with existing files. If any conflicts are detected, the
@@ -779,40 +1367,491 @@ def batch_rename(renamings):
         renamings = [(Path('file1.txt'), 'new_file1.txt'), (Path('file2.txt'), 'new_file2.txt')]
         batch_rename(renamings)
     """
-    files = [f for f, _ in renamings]
-    dst_files = [f.with_name(name) for f, name in renamings]
-
-    if len(set(files)) != len(files):
-        print('[E] There are duplicate files in the list! Please check.')
+    plan = _plan_renames(renamings, verbose=verbose)
+    if plan is None:
         return
+    if journal:
+        journal = Path(journal)
+        if journal.exists():
+            print(f'[E] Journal {journal} already exists. Resume or roll back the unfinished batch first.')
+            return
+        journal.parent.mkdir(parents=True, exist_ok=True)
+        # write-ahead: the whole plan is on disk before the first rename.
+        with journal.open('w', encoding='utf-8') as fio:
+            fio.write(json.dumps({'plan': [[str(src), str(dst)] for src, dst in plan]}, ensure_ascii=False) + '\n')
+            fio.flush()
+            os.fsync(fio.fileno())
+    _run_rename_plan(plan, journal=journal, workers=workers)
+
+def resume_batch_rename(journal, workers=1):
+    '''Finish an interrupted batch_rename() from its journal.'''
+    plan, done = _load_rename_journal(journal)
+    print(f'[I] Resuming: {len(done)}/{len(plan)} renames are done.')
+    _run_rename_plan(plan, journal=journal, done=done, workers=workers)
+
+def rollback_batch_rename(journal):
+    '''Undo an interrupted batch_rename() from its journal, renaming the files back.'''
+    plan, done = _load_rename_journal(journal)
+    print(f'[I] Rolling back {len(done)} renames.')
+    _rollback_rename_plan(plan, done, journal)
+
+class TwitterFilename(NamedTuple):
+    '''A parsed TWITTER_FILENAME_RE (or the relaxed one, then `relaxed` is True) filename. See parse_filename().'''
+    screen_name: str
+    id: int
+    date: str # YYYYMMDD
+    time: str # HHMMSS
+    type: str # img, vid, gif, etc.
+    index: Optional[int]
+    dupe: Optional[int] # 2 for "... (2).jpg"
+    suffix: str # with the dot
+    prefix: str = ''
+    extra: str = '' # with leading space/hyphen/underscore
+    relaxed: bool = False
+
+    @property
+    def datetime(self):
+        return datetime.strptime(self.date + self.time, '%Y%m%d%H%M%S')
+
+class InstagramFilename(NamedTuple):
+    '''A parsed INSTAGRAM_FILENAME_RE filename. See parse_filename().'''
+    date: str # YYMMDD
+    user_id: str
+    post_id: Optional[str]
+    story_id: Optional[int]
+    index: Optional[int]
+    suffix: str # with the dot
+
+# every Twitter filename (strict or relaxed) has "-{id}-{date}_{time}-" in it; much cheaper to search for than the relaxed pattern.
+_TWITTER_CORE_RE = re.compile(r'-\d+-\d{8}_\d{6}-')
+_TWITTER_SUFFIXES = ('.mp4', '.zip', '.jpg', '.png')
+
+def _int_or_none(s):
+    return int(s) if s else None
+
+def _twitter_record(m, relaxed):
+    g = m.groupdict()
+    return TwitterFilename(g['screen_name'], int(g['id']), g['date'], g['time'], g['type'], _int_or_none(g['index']),
+                           int(g['dupe'].strip(' ()')) if g['dupe'] else None, g['suffix'],
+                           g.get('prefix') or '', g.get('extra') or '', relaxed)
+
+@lru_cache(maxsize=65536)
+def parse_filename(name):
+    '''
+    Parse a filename in one of my formats (TWITTER_FILENAME_RE, INSTAGRAM_FILENAME_RE, TWITTER_FILENAME_RELEXED_RE, in this order)
+    into a TwitterFilename or InstagramFilename record. Returns None if it's none of them.
 
-    if len(set(dst_files)) != len(dst_files):
-        print('[E] There are duplicate new filenames in the list! Please check.')
-        return
+    The patterns are only tried when a cheap check passes (suffix and the "-id-date_time-" core for Twitter, "YYMMDD_" for Instagram),
+    so the (slow, backtracking) relaxed pattern runs on few names only.
+    '''
+    is_twitter = name.endswith(_TWITTER_SUFFIXES) and _TWITTER_CORE_RE.search(name)
+    if is_twitter and (m := TWITTER_FILENAME_RE.match(name)):
+        return _twitter_record(m, False)
+    if name[6:7] == '_' and name[:6].isdigit() and (m := INSTAGRAM_FILENAME_RE.match(name)):
+        return InstagramFilename(m['date'], m['user_id'], m['post_id'], _int_or_none(m['story_id']), _int_or_none(m['index']), m['suffix'])
+    if is_twitter and (m := TWITTER_FILENAME_RELEXED_RE.match(name)):
+        return _twitter_record(m, True)
+    return None
+
+def classify_filenames(names):
+    '''
+    Parse lots of filenames (str or Path) with parse_filename().
+    Returns a list of records (TwitterFilename, InstagramFilename or None), in the same order as names.
+    '''
+    return [parse_filename(name if isinstance(name, str) else name.name) for name in names]
 
-    # if new filename is conflicting and not in our current files, abort
-    for new_f in dst_files:
-        if new_f.exists() and new_f not in files:
-            print(f'[E] file {new_f.name} already exists. Please rename it first.')
+# ==================== network related ====================
+class TokenBucket:
+    '''
+    A thread-safe token bucket with `rate` tokens per second, holding up to `capacity` tokens (default: 1 second worth).
+    reserve() takes the tokens right away (going into debt if there are not enough) and returns how long the caller should wait,
+    so it works for both threads (time.sleep) and asyncio (asyncio.sleep).
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount=1):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+class _SharedSlots:
+    '''
+    A semaphore shared by threads and asyncio tasks (of any event loop): threads block and tasks await, first come
+    first served, and a released slot is handed directly to the next waiter. Nothing polls, and no executor thread
+    is ever blocked for a task (those are needed for e.g. aiohttp's DNS resolving).
+    '''
+    def __init__(self, value):
+        self._value = value
+        self._lock = threading.Lock()
+        # threading.Event for a thread, (loop, future) for a task
+        self._waiters = collections.deque()
+
+    def acquire(self, blocking=True):
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return True
+            if not blocking:
+                return False
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+        return True
+
+    async def acquire_async(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._value > 0 and not self._waiters:
+                self._value -= 1
+                return
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                handed = waiter not in self._waiters
+                if not handed:
+                    self._waiters.remove(waiter)
+            # if a slot is on its way to us, _deliver() gives it back since the future is cancelled;
+            # if it has already arrived (and the task is cancelled right after), give it back here.
+            if handed and future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if not self._waiters:
+                self._value += 1
+                return
+            waiter = self._waiters.popleft()
+        if isinstance(waiter, threading.Event):
+            waiter.set()
             return
-    # rename current file(s) to temp filename to make renaming possible
-    real_renamings = []
-    for f, name in renamings:
-        if f in dst_files:
-            temp_f = ensure_nonexist(f.with_name(f.stem + '_temp' + f.suffix))
-            print(f'[I] temporarily rename {f.name} to {temp_f.name}')
-            f = f.rename(temp_f)
-        real_renamings.append((f, name))
+        loop, future = waiter
+        try:
+            loop.call_soon_threadsafe(self._deliver, future)
+        except RuntimeError: # the loop is closed
+            self.release()
+
+    def _deliver(self, future):
+        if future.done(): # cancelled in the meantime
+            self.release()
+        else:
+            future.set_result(None)
 
-    for f, name in real_renamings:
-        f.rename(f.with_name(name))
+class _HostSlot:
+    '''A connection slot of a HostLimiter. It can be released early; releasing it again does nothing.'''
+    def __init__(self, semaphore):
+        self._semaphore = semaphore
+        self._held = False
+
+    def __enter__(self):
+        if self._semaphore:
+            self._semaphore.acquire()
+            self._held = True
+        return self
+
+    def release(self):
+        if self._held:
+            self._held = False
+            self._semaphore.release()
+
+    def __exit__(self, *args):
+        self.release()
+
+class HostLimiter:
+    '''
+    Limits for one host: max concurrent connections, requests per second and bytes per second (None means unlimited).
+    It is shared by threads and asyncio tasks, so sync and async downloaders going to the same host share the same limits.
+    '''
+    def __init__(self, connections=None, rps=None, bps=None):
+        self.connections = connections
+        self.rps = rps
+        self.bps = bps
+        self._semaphore = _SharedSlots(connections) if connections else None
+        self._requests = TokenBucket(rps) if rps else None
+        self._bytes = TokenBucket(bps) if bps else None
+
+    def slot(self):
+        '''A context manager holding one connection slot, e.g. for the whole streaming of a download.'''
+        return _HostSlot(self._semaphore)
+
+    def wait_request(self):
+        if self._requests:
+            time.sleep(self._requests.reserve())
+
+    def throttle(self, nbytes):
+        if self._bytes and nbytes:
+            time.sleep(self._bytes.reserve(nbytes))
+
+    async def aslot_acquire(self):
+        '''The asyncio version of slot().__enter__() + wait_request() (aiohttp doesn't go through our requests adapter).'''
+        import asyncio
+        slot = _HostSlot(self._semaphore)
+        if self._semaphore:
+            await self._semaphore.acquire_async()
+            slot._held = True
+        if self._requests:
+            await asyncio.sleep(self._requests.reserve())
+        return slot
+
+    async def athrottle(self, nbytes):
+        import asyncio
+        if self._bytes and nbytes:
+            await asyncio.sleep(self._bytes.reserve(nbytes))
+
+class RateScheduler:
+    '''
+    A process-wide registry of HostLimiter per host. Set limits with set_host_limit(); hosts without limits are unlimited,
+    unless a default is set for '*'. A limit set for "example.com" also applies to (and is shared with) its subdomains.
+    '''
+    def __init__(self):
+        self._configs = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def set_limit(self, host, connections=None, rps=None, bps=None):
+        with self._lock:
+            self._configs[host] = dict(connections=connections, rps=rps, bps=bps)
+            # drop the limiters created from the old configs; new ones are created on next use.
+            self._limiters.clear()
+
+    def limiter(self, url_or_host):
+        from urllib.parse import urlparse
+
+        host = urlparse(url_or_host).hostname if '://' in url_or_host else url_or_host
+        host = host or ''
+        with self._lock:
+            key = next((h for h in self._configs if h != '*' and (host == h or host.endswith('.' + h))), None)
+            if key is None:
+                key = host
+            if key not in self._limiters:
+                config = self._configs.get(key) or self._configs.get('*') or {}
+                self._limiters[key] = HostLimiter(**config)
+            return self._limiters[key]
+
+_scheduler = RateScheduler()
+
+def set_host_limit(host, connections=None, rps=None, bps=None):
+    '''
+    Limit the max concurrent (download) connections, requests per second and/or bytes per second to a host,
+    for all the downloaders using util (download, download_batch, get, sessions from requests_retry_session, etc.).
+    Use '*' as host to set the default for all the other hosts.
+
+    Example usage:
+        set_host_limit('stat.ameba.jp', connections=16, rps=20)
+        set_host_limit('fbcdn.net', bps=20 * 1024 * 1024)
+    '''
+    _scheduler.set_limit(host, connections=connections, rps=rps, bps=bps)
+
+def host_limiter(url_or_host):
+    '''Get the HostLimiter for the host of a URL.'''
+    return _scheduler.limiter(url_or_host)
+
+class Metrics:
+    """
+    Thread-safe per-host HTTP metrics: request counts by status, time to first byte (histogram), bytes and transfer time,
+    retries and backoff (from urllib3's Retry), and errors.
+
+    The sessions from requests_retry_session()/get_session(), download(), download_batch() and get() all record into
+    the module-level `metrics`, so at the end of a run you can see which host is the bottleneck:
+
+        metrics.report()                # print a summary
+        metrics.save('metrics.json')    # or 'metrics.prom' for the Prometheus text format
+    """
+    TTFB_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._hosts = {}
+
+    def _host(self, url):
+        # only called with the lock held
+        from urllib.parse import urlparse
+
+        host = urlparse(url).hostname or url
+        if host not in self._hosts:
+            self._hosts[host] = {'requests': 0, 'status': {}, 'errors': 0, 'retries': 0, 'backoff_seconds': 0.0,
+                                 'ttfb_buckets': [0] * (len(self.TTFB_BUCKETS) + 1), 'ttfb_sum': 0.0, 'ttfb_max': 0.0,
+                                 'bytes': 0, 'transfer_seconds': 0.0}
+        return self._hosts[host]
+
+    def record_response(self, url, status, ttfb):
+        '''A response (headers) was received, ttfb seconds after the request was sent.'''
+        with self._lock:
+            h = self._host(url)
+            h['requests'] += 1
+            h['status'][status] = h['status'].get(status, 0) + 1
+            h['ttfb_sum'] += ttfb
+            h['ttfb_max'] = max(h['ttfb_max'], ttfb)
+            for i, le in enumerate(self.TTFB_BUCKETS):
+                if ttfb <= le:
+                    break
+            else:
+                i = len(self.TTFB_BUCKETS)
+            h['ttfb_buckets'][i] += 1
+
+    def record_error(self, url):
+        '''A request failed without a response (connection error, timeout...).'''
+        with self._lock:
+            self._host(url)['errors'] += 1
+
+    def record_retry(self, url, backoff=0.0):
+        with self._lock:
+            h = self._host(url)
+            h['retries'] += 1
+            h['backoff_seconds'] += backoff
+
+    def record_transfer(self, url, size, seconds):
+        '''size bytes of a body were read in seconds.'''
+        with self._lock:
+            h = self._host(url)
+            h['bytes'] += size
+            h['transfer_seconds'] += seconds
+
+    def to_dict(self):
+        '''{host: {requests, status, errors, retries, backoff_seconds, ttfb_mean, ttfb_max, ttfb_histogram, bytes, transfer_seconds, bytes_per_sec}}'''
+        with self._lock:
+            result = {}
+            for host, h in sorted(self._hosts.items()):
+                les = [str(le) for le in self.TTFB_BUCKETS] + ['+Inf']
+                result[host] = {
+                    'requests': h['requests'],
+                    'status': {str(k): v for k, v in sorted(h['status'].items())},
+                    'errors': h['errors'],
+                    'retries': h['retries'],
+                    'backoff_seconds': round(h['backoff_seconds'], 3),
+                    'ttfb_mean': round(h['ttfb_sum'] / h['requests'], 4) if h['requests'] else None,
+                    'ttfb_max': round(h['ttfb_max'], 4),
+                    'ttfb_histogram': dict(zip(les, h['ttfb_buckets'])),
+                    'bytes': h['bytes'],
+                    'transfer_seconds': round(h['transfer_seconds'], 3),
+                    'bytes_per_sec': round(h['bytes'] / h['transfer_seconds']) if h['transfer_seconds'] else None,
+                }
+            return result
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix='util_http'):
+        '''The metrics in the Prometheus text exposition format.'''
+        with self._lock:
+            hosts = {host: {**h, 'status': dict(h['status']), 'ttfb_buckets': list(h['ttfb_buckets'])} for host, h in sorted(self._hosts.items())}
+        lines = []
+        def metric(name, type_, help_, samples):
+            # samples: [(suffix, labels, value)] for histograms, [(labels, value)] otherwise
+            lines.append(f'# HELP {prefix}_{name} {help_}')
+            lines.append(f'# TYPE {prefix}_{name} {type_}')
+            for sample in samples:
+                suffix, labels, value = sample if len(sample) == 3 else ('', *sample)
+                label_str = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f'{prefix}_{name}{suffix}{{{label_str}}} {value}')
+
+        metric('requests_total', 'counter', 'Responses received, by host and status.',
+               [({'host': host, 'status': status}, n) for host, h in hosts.items() for status, n in sorted(h['status'].items())])
+        metric('errors_total', 'counter', 'Requests failed without a response.', [({'host': host}, h['errors']) for host, h in hosts.items()])
+        metric('retries_total', 'counter', 'Retries done by urllib3 Retry / download_batch.', [({'host': host}, h['retries']) for host, h in hosts.items()])
+        metric('backoff_seconds_total', 'counter', 'Time slept before retries.', [({'host': host}, h['backoff_seconds']) for host, h in hosts.items()])
+        ttfb = []
+        for host, h in hosts.items():
+            cumulative = 0
+            for le, n in zip([*self.TTFB_BUCKETS, '+Inf'], h['ttfb_buckets']):
+                cumulative += n
+                ttfb.append(('_bucket', {'host': host, 'le': le}, cumulative))
+            ttfb.append(('_sum', {'host': host}, h['ttfb_sum']))
+            ttfb.append(('_count', {'host': host}, h['requests']))
+        metric('ttfb_seconds', 'histogram', 'Time to first byte (response headers).', ttfb)
+        metric('downloaded_bytes_total', 'counter', 'Body bytes read.', [({'host': host}, h['bytes']) for host, h in hosts.items()])
+        metric('transfer_seconds_total', 'counter', 'Time spent reading bodies.', [({'host': host}, h['transfer_seconds']) for host, h in hosts.items()])
+        return '\n'.join(lines) + '\n'
+
+    def save(self, file):
+        '''Save the metrics to file: Prometheus text format if it ends with .prom or .txt, otherwise JSON.'''
+        file = Path(file)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        text = self.to_prometheus() if file.suffix in ['.prom', '.txt'] else self.to_json()
+        file.write_text(text, encoding='utf-8')
+
+    def report(self):
+        '''Print a summary table, one line per host.'''
+        print(f'{"host":<30} {"reqs":>6} {"errs":>5} {"retry":>5} {"ttfb avg":>8} {"ttfb max":>8} {"MB":>9} {"speed":>12}  status')
+        for host, h in self.to_dict().items():
+            speed = format_speed(h['bytes'], h['transfer_seconds']) if h['transfer_seconds'] else '-'
+            ttfb_mean = f'{h["ttfb_mean"]:.3f}' if h['ttfb_mean'] is not None else '-'
+            status = ' '.join(f'{k}:{v}' for k, v in h['status'].items())
+            print(f'{host[:30]:<30} {h["requests"]:>6} {h["errors"]:>5} {h["retries"]:>5} {ttfb_mean:>8} {h["ttfb_max"]:>8.3f} {h["bytes"] / 1024 / 1024:>9.2f} {speed:>12}  {status}')
+
+metrics = Metrics()
+
+_limited_adapter_class = None
+_counting_retry_class = None
+# the URL being sent by the adapter in this thread, for CountingRetry.
+_sending = threading.local()
+
+def _make_retry(**kwargs):
+    '''Create a urllib3 Retry that records the retries (and backoff) it does in `metrics`.'''
+    from urllib3.util.retry import Retry
+
+    global _counting_retry_class
+    if _counting_retry_class is None:
+        class CountingRetry(Retry):
+            def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+                new_retry = super().increment(method=method, url=url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+                # count it for the URL the adapter is sending (url here is only the path).
+                request_url = getattr(_sending, 'url', None) or (f'http://{_pool.host}' if _pool is not None else '')
+                metrics.record_retry(request_url, new_retry.get_backoff_time())
+                return new_retry
+        _counting_retry_class = CountingRetry
+    return _counting_retry_class(**kwargs)
+
+def _make_adapter(max_retries, pool_maxsize):
+    '''
+    Create an HTTPAdapter that waits for the request rate limit of the host (see set_host_limit()) before each request,
+    and records the responses in `metrics`.
+    '''
+    from requests.adapters import HTTPAdapter
+
+    global _limited_adapter_class
+    if _limited_adapter_class is None:
+        class LimitedHTTPAdapter(HTTPAdapter):
+            def send(self, request, **kwargs):
+                host_limiter(request.url).wait_request()
+                t = time.perf_counter()
+                _sending.url = request.url
+                try:
+                    r = super().send(request, **kwargs)
+                except Exception:
+                    metrics.record_error(request.url)
+                    raise
+                finally:
+                    _sending.url = None
+                # the body isn't read yet here, so this is the time to first byte (r.elapsed is only set by the session after this).
+                metrics.record_response(request.url, r.status_code, time.perf_counter() - t)
+                return r
+        _limited_adapter_class = LimitedHTTPAdapter
+    return _limited_adapter_class(max_retries=max_retries, pool_maxsize=pool_maxsize)
 
-# ==================== network related ====================
 def requests_retry_session(
     retries=5,
     backoff_factor=0.2,
     status_forcelist=(502, 503, 504),
     session=None,
+    pool_maxsize=10,
 ):
     """
     Create a session object with retry functionality for making HTTP requests.
@@ -823,28 +1862,140 @@ def requests_retry_session(
         backoff_factor (float): The backoff factor between retries. Default is 0.2.
         status_forcelist (tuple): A tuple of HTTP status codes that should trigger a retry. Default is (502, 503, 504).
         session (requests.Session): An existing session object to use. If not provided, a new session will be created.
+        pool_maxsize (int): The maximum number of connections to keep per host. Default is 10.
 
     Returns:
-        requests.Session: The session object with retry functionality.
+        requests.Session: The session object with retry functionality (and the request rate limits set by set_host_limit()).
+            Its requests and retries are recorded in `metrics`.
 
     """
     # pip install requests urllib3
     import requests
-    from requests.adapters import HTTPAdapter
-    from urllib3.util.retry import Retry
 
     session = session or requests.Session()
-    retry = Retry(
+    retry = _make_retry(
         total=retries,
         backoff_factor=backoff_factor,
         status_forcelist=status_forcelist,
     )
-    adapter = HTTPAdapter(max_retries=retry)
+    adapter = _make_adapter(max_retries=retry, pool_maxsize=pool_maxsize)
     session.mount('http://', adapter)
     session.mount('https://', adapter)
     return session
 
-def get(url, headers=None, cookies=None, encoding=None, session=None, parser='lxml', timeout=None):
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def get_session(key='default', pool_maxsize=32, host_pool_sizes=None):
+    """
+    Get a shared session (created by requests_retry_session) from a process-wide registry, creating it on first use.
+    Creating a new session (and doing the TLS handshakes again) is expensive, so the same session is reused across calls and threads.
+    Since it is shared, do NOT modify its headers or cookies; pass them per request instead, or use your own key.
+
+    Args:
+        key (str): The name of the session in the registry. Default is 'default'.
+        pool_maxsize (int): The maximum number of connections to keep per host. Only used when the session is created. Default is 32.
+        host_pool_sizes (dict): {host: pool_maxsize} for hosts that need a different pool size, e.g. a CDN that is hit by many threads at once.
+
+    Returns:
+        requests.Session: The shared session object.
+    """
+    # pip install requests
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = requests_retry_session(pool_maxsize=pool_maxsize)
+        session = _sessions[key]
+        for host, size in (host_pool_sizes or {}).items():
+            for scheme in ['http', 'https']:
+                prefix = f'{scheme}://{host}/'
+                adapter = session.adapters.get(prefix)
+                if adapter is None or adapter._pool_maxsize != size:
+                    # requests picks the adapter with the longest matching prefix, so this only affects this host.
+                    max_retries = session.get_adapter(f'{scheme}://').max_retries
+                    session.mount(prefix, _make_adapter(max_retries=max_retries, pool_maxsize=size))
+    return session
+
+class HttpCache:
+    """
+    A conditional GET cache on disk. The body of a response is stored with its ETag/Last-Modified, which are sent back as
+    If-None-Match/If-Modified-Since next time; on 304 the stored body (and the parsed result, if it's still in memory) is used.
+    Used by get(cache=...), and can be used with any session via fetch() and get_parsed().
+
+    Note: responses are keyed by URL only, so don't share a cache between requests with different cookies/logins.
+    The parsed results are shared too, so don't modify them in place.
+
+    Args:
+        cache_dir (str): The folder to save the cached responses in.
+        max_parsed (int, optional): The number of parsed results to keep in memory. Defaults to 32.
+    """
+    def __init__(self, cache_dir, max_parsed=32):
+        from collections import OrderedDict
+
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_parsed = max_parsed
+        self._parsed = OrderedDict() # (url_key, parse_key) -> (validators, parsed result)
+        self._lock = threading.Lock()
+
+    def _files(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return self.cache_dir / f'{key}.json', self.cache_dir / f'{key}.body'
+
+    def fetch(self, url, session=None, headers=None, cookies=None, timeout=None):
+        '''
+        GET url conditionally.
+
+        Returns:
+            tuple: (content (bytes), validators (tuple or None), from_cache (bool)). validators is None if the response can't be cached.
+        '''
+        if not session:
+            session = get_session()
+        meta_file, body_file = self._files(url)
+        meta = None
+        headers = dict(headers or {})
+        if meta_file.exists() and body_file.exists():
+            meta = load_json(meta_file)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        r = session.get(url, headers=headers, cookies=cookies, timeout=timeout)
+        if r.status_code == 304 and meta:
+            return body_file.read_bytes(), (meta.get('etag'), meta.get('last_modified')), True
+        content = r.content
+        etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+        if r.status_code != 200 or not (etag or last_modified):
+            return content, None, False
+        # write the body first, so the meta never points to a body that isn't there yet.
+        temp_body = body_file.with_name(f'{body_file.name}.{threading.get_ident()}.tmp')
+        temp_body.write_bytes(content)
+        temp_body.replace(body_file)
+        temp_meta = meta_file.with_name(f'{meta_file.name}.{threading.get_ident()}.tmp')
+        temp_meta.write_text(json.dumps({'url': url, 'etag': etag, 'last_modified': last_modified}), encoding='utf-8')
+        temp_meta.replace(meta_file)
+        return content, (etag, last_modified), False
+
+    def get_parsed(self, url, parse, parse_key=None, **kwargs):
+        '''
+        Like fetch(), but return parse(content). On 304, the same parsed result is returned without parsing again if it's in memory.
+        parse_key identifies how it's parsed (e.g. the parser name) if the same URL is parsed differently. kwargs are passed to fetch().
+        '''
+        content, validators, from_cache = self.fetch(url, **kwargs)
+        key = (url, parse_key)
+        with self._lock:
+            if from_cache and key in self._parsed and self._parsed[key][0] == validators:
+                self._parsed.move_to_end(key)
+                return self._parsed[key][1]
+        result = parse(content)
+        if validators:
+            with self._lock:
+                self._parsed[key] = (validators, result)
+                self._parsed.move_to_end(key)
+                while len(self._parsed) > self.max_parsed:
+                    self._parsed.popitem(last=False)
+        return result
+
+def get(url, headers=None, cookies=None, encoding=None, session=None, parser='lxml', timeout=None, cache=None):
     """
     Sends a GET request to the specified URL and returns the parsed HTML content.
 
@@ -856,6 +2007,7 @@ def get(url, headers=None, cookies=None, encoding=None, session=None, parser='lx
         session (requests.Session, optional): The session to use for the request. Defaults to None.
         parser (str, optional): The parser to use for parsing the HTML content. Defaults to 'lxml'.
         timeout (float, optional): The maximum number of seconds to wait for the request to complete. Defaults to None.
+        cache (HttpCache, optional): If given, use conditional GET and return the cached (parsed) page if it's not modified. Defaults to None.
 
     Returns:
         BeautifulSoup: The parsed HTML content.
@@ -870,13 +2022,18 @@ def get(url, headers=None, cookies=None, encoding=None, session=None, parser='lx
     """
     from bs4 import BeautifulSoup
 
+    def parse(content):
+        if encoding:
+            return BeautifulSoup(content, parser, from_encoding=encoding)
+        else:
+            return BeautifulSoup(content, parser)
+
     if not session:
-        session = requests_retry_session()
+        session = get_session()
+    if cache is not None:
+        return cache.get_parsed(url, parse, parse_key=(parser, encoding), session=session, headers=headers, cookies=cookies, timeout=timeout)
     r = session.get(url, cookies=cookies, headers=headers, timeout=timeout)
-    if encoding:
-        return BeautifulSoup(r.content, parser, from_encoding=encoding)
-    else:
-        return BeautifulSoup(r.content, parser)
+    return parse(r.content)
 
 def get_webname(url):
     return unquote(url.split('?')[0].split('/')[-1])
@@ -949,216 +2106,344 @@ def load_cookie(s):
 
     raise ValueError(f'Invalid cookie string: {s}')
 
-def download(url, filename=None, save_path='.', cookies=None, session=None, dry_run=False,
-             dupe='skip_same_size', referer=None, headers=None, placeholder=True, prefix='',
-             get_suffix=True, verbose=2, retry_failed=True):
+class DownloadIndex:
     """
-    Downloads a file from the given URL and saves it to the specified location.
+    An on-disk (SQLite) index of finished downloads, keyed by URL, with the final path, size and hash.
+
+    Pass it to download()/download_batch() (or the scrapers) with `index=`: a URL already in the index is
+    skipped with a single indexed lookup, instead of probing the filesystem (which is slow on network shares).
+    Only downloads done with the index are recorded, so it doesn't know about files downloaded without it.
 
     Args:
-        url (str): The URL of the file to download.
-        filename (str, optional): The name of the file to save. If not provided, the filename will be extracted from the URL or the response header. Defaults to None.
-        save_path (str, optional): The directory path to save the file. Defaults to '.' (current directory).
-        cookies (dict, optional): A dictionary of cookies to include in the request. Defaults to None.
-        session (requests.Session, optional): A requests Session object to use for the request. Defaults to None.
-        dry_run (bool, optional): If True, only prints the URL and does not perform the actual download. Defaults to False.
-        dupe (str, optional): The method to handle duplicate files. Must be one of 'skip', 'overwrite', 'rename', or 'skip_same_size'. Defaults to 'skip_same_size'.
-        referer (str, optional): The referer header to include in the request. Defaults to None.
-        headers (dict, optional): Additional headers to include in the request. Defaults to None.
-        placeholder (bool, optional): If True, creates a placeholder file with a '.broken' extension if the download fails. Defaults to True.
-        prefix (str, optional): A prefix to add to the filename. Useful when fetching the filename from the response headers. Defaults to ''.
-        get_suffix (bool, optional): If True, attempts to determine the file extension from the response headers. Defaults to True.
-        verbose (int, optional): The verbosity level of the download progress. Must be 0, 1, or 2. Defaults to 2.
-        retry_failed (bool, optional): If True, retries the download if it fails. Defaults to True.
+        db_file (str): The SQLite file. Created if it doesn't exist.
+        url_key (function, optional): Normalize URLs before using them as key, e.g. to strip expiring signature
+            parameters: `url_key=lambda url: url.split('?')[0]`. Defaults to None (use URLs as is).
 
-    Returns:
-        str: The status of the download. Can be 'Dry run', 'Exists', or the HTTP status code.
+    Example usage:
+        index = DownloadIndex('downloads.db')
+        download(url, save_path='images', index=index)
     """
-    from mimetypes import guess_extension
-    # it uses requests_retry_session, so
-    # pip install requests
+    def __init__(self, db_file, url_key=None):
+        import sqlite3
+
+        self.url_key = url_key or (lambda url: url)
+        self.db_file = Path(db_file)
+        self.db_file.parent.mkdir(parents=True, exist_ok=True)
+        # one connection shared by all threads, guarded by our own lock.
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS downloads (url TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER, hash TEXT, time REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS downloads_path ON downloads (path)')
+
+    @staticmethod
+    def _path_key(path):
+        # abspath instead of resolve(), since it doesn't touch the filesystem.
+        return os.path.abspath(path)
+
+    def get(self, url):
+        '''Return the record (a dict with url, path, size, hash and time) of url, or None if it is not downloaded.'''
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM downloads WHERE url = ?', (self.url_key(url),)).fetchone()
+        return dict(row) if row else None
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    def find_by_path(self, path):
+        '''Return the record of the download saved at path, or None.'''
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM downloads WHERE path = ?', (self._path_key(path),)).fetchone()
+        return dict(row) if row else None
+
+    def add(self, url, path, size=None, hash=None):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO downloads (url, path, size, hash, time) VALUES (?, ?, ?, ?, ?)',
+                               (self.url_key(url), self._path_key(path), size, hash, time.time()))
+
+    def remove(self, url):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM downloads WHERE url = ?', (self.url_key(url),))
+
+    def paths(self, under=None):
+        '''Return the paths of all the downloads (that are inside `under`, if given).'''
+        with self._lock:
+            if under is None:
+                rows = self._conn.execute('SELECT path FROM downloads').fetchall()
+            else:
+                prefix = os.path.join(self._path_key(under), '')
+                # a range query instead of LIKE, so it can use the index (and doesn't care about wildcards in paths).
+                rows = self._conn.execute('SELECT path FROM downloads WHERE path >= ? AND path < ?', (prefix, prefix + '\U0010ffff')).fetchall()
+        return [Path(row[0]) for row in rows]
+
+    def children(self, directory):
+        '''Return the names of the direct children of directory that have downloads in them (like iterdir(), but from the index).'''
+        directory = self._path_key(directory)
+        return {Path(os.path.relpath(p, directory)).parts[0] for p in self.paths(under=directory)}
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM downloads').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _reflink(src, dst):
+    '''Copy-on-write clone src to dst (Linux, on btrfs/XFS etc.). Raises OSError if it's not supported.'''
+    if sys.platform != 'linux':
+        raise OSError('reflink is only supported on Linux')
+    import fcntl
+    FICLONE = 0x40049409
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.unlink(dst)
+            raise
+
+class BlobStore:
+    """
+    A content-addressed store for downloads: each distinct content is stored once, as {root}/{hex[:2]}/{hex[2:4]}/{hex},
+    and the actual (templated) paths are hardlinks to it (or reflinks, or copies as the last resort, e.g. across drives).
+    Pass it to download(store=...) (and the scrapers) so the same image under different names/folders takes the space only once.
 
-    if dupe not in ['skip', 'overwrite', 'rename', 'skip_same_size']:
-        raise ValueError(f'[Error] Invalid dupe method: {dupe} (must be either skip, overwrite, rename or skip_same_size).')
+    Note: hardlinked files share the content, so editing one in place changes all of them.
+
+    Args:
+        root (str): The folder of the store. Should be on the same drive as the downloads for hardlinks to work.
+        algo (str, optional): The hash algorithm (see new_hasher()). Defaults to 'blake2b'.
+    """
+    def __init__(self, root, algo='blake2b'):
+        self.root = Path(root)
+        self.algo = algo
+        self._hex_length = len(new_hasher(algo).hexdigest())
+
+    def path(self, digest):
+        '''The blob path of a digest, either "{algo}:{hexdigest}" or just the hexdigest.'''
+        algo, _, hexdigest = digest.rpartition(':')
+        if algo and algo != self.algo:
+            raise ValueError(f'{digest} is not a {self.algo} digest.')
+        return self.root / hexdigest[:2] / hexdigest[2:4] / hexdigest
+
+    def __contains__(self, digest):
+        '''A digest of another algorithm (e.g. from a .sha256 sidecar) or a malformed one is simply not in the store.'''
+        if not digest:
+            return False
+        algo, _, hexdigest = digest.rpartition(':')
+        if (algo and algo != self.algo) or len(hexdigest) != self._hex_length:
+            return False
+        return self.path(digest).exists()
 
+    def link(self, digest, f):
+        '''Create f with the content of digest (which must be in the store).'''
+        blob = self.path(digest)
+        f = Path(f)
+        f.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(blob, f)
+        except OSError:
+            try:
+                _reflink(blob, f)
+            except OSError:
+                shutil.copy2(blob, f)
+
+    def add(self, file, digest, f=None):
+        '''
+        Move file into the store (or just delete it, if the same content is already there), then link it to f if given.
+        Returns:
+            bool: whether the content is new to the store.
+        '''
+        blob = self.path(digest)
+        blob.parent.mkdir(parents=True, exist_ok=True)
+        # claim the blob with os.link, which fails if it exists, instead of exists() then move():
+        # two threads (or processes) adding the same content at once would otherwise both "win".
+        try:
+            try:
+                os.link(file, blob)
+            except FileExistsError:
+                raise
+            except OSError:  # e.g. across drives: copy next to the blob first, then claim it the same way
+                tmp = blob.with_name(f'{blob.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+                shutil.copy2(file, tmp)
+                try:
+                    os.link(tmp, blob)
+                except FileExistsError:
+                    raise
+                except OSError:  # no hardlinks at all; same content, so replacing a concurrent copy is harmless
+                    os.replace(tmp, blob)
+                finally:
+                    tmp.unlink(missing_ok=True)
+            is_new = True
+        except FileExistsError:
+            is_new = False
+        Path(file).unlink()
+        if f is not None:
+            self.link(digest, f)
+        return is_new
+
+# ==================== download helpers ====================
+# shared by download() and download_batch(), so both handle filenames and dupes the same way.
+
+def _make_print(verbose):
+    '''Return a print function that only prints messages within the given verbosity level.'''
     def print(s, verbose_level, only=False):
         if (only and verbose == verbose_level) or (not only and verbose >= verbose_level):
             builtins.print(s)
+    return print
 
-    def has_valid_suffix(f):
-        # common suffixes
-        if f.suffix.lower() in ['.jpg', '.png', '.gif', '.webp', '.jpeg', '.bmp', '.svg', '.ico', '.mp4', '.mkv', '.webm', '.heic', '.pdf']:
-            return True
-        if f.suffix.lower() in ['.php', '']:
-            return False
-        # if the suffix is too long, has a space, etc., we assume it is not a valid suffix
-        if len(f.suffix.lower()) > 5 or ' ' in f.suffix.lower():
-            return False
+def _has_valid_suffix(f):
+    # common suffixes
+    if f.suffix.lower() in ['.jpg', '.png', '.gif', '.webp', '.jpeg', '.bmp', '.svg', '.ico', '.mp4', '.mkv', '.webm', '.heic', '.pdf']:
         return True
+    if f.suffix.lower() in ['.php', '']:
+        return False
+    # if the suffix is too long, has a space, etc., we assume it is not a valid suffix
+    if len(f.suffix.lower()) > 5 or ' ' in f.suffix.lower():
+        return False
+    return True
+
+def _replace_suffix(f, content_type, print):
+    from mimetypes import guess_extension
 
-    def replace_suffix(f, content_type):
-
-        # some URLs have multiple mime types in the header, e.g.
-        # https://prd-pspa-s3-content.s3.ap-northeast-1.amazonaws.com/public/18255769761JOGWTUQPoSQXniAYcDMKy.jpg
-        # Content-Type: image/png; image/jpg; image/jpeg
-        header_suffixes = []
-        for mime in content_type.split(';'):
-            mime = mime.strip().lower()
+    # some URLs have multiple mime types in the header, e.g.
+    # https://prd-pspa-s3-content.s3.ap-northeast-1.amazonaws.com/public/18255769761JOGWTUQPoSQXniAYcDMKy.jpg
+    # Content-Type: image/png; image/jpg; image/jpeg
+    header_suffixes = []
+    for mime in content_type.split(';'):
+        mime = mime.strip().lower()
+        header_suffix = ''
+        guess = guess_extension(mime, strict=False)
+        suffix_from_mime = mime.split('/')[-1].lower()
+        # manually set suffix for some common types that isn't covered by guess_extension
+        maps = {
+            'audio/mp4': '.m4a',
+            'audio/x-m4a': '.m4a',
+            'image/webp': '.webp',
+        }
+        if mime in maps:
+            header_suffix = maps[mime]
+        # if 'application/octet-stream', just use the original suffix (guess_extension gives .bin)
+        elif mime == 'application/octet-stream':
             header_suffix = ''
-            guess = guess_extension(mime, strict=False)
-            suffix_from_mime = mime.split('/')[-1].lower()
-            # manually set suffix for some common types that isn't covered by guess_extension
-            maps = {
-                'audio/mp4': '.m4a',
-                'audio/x-m4a': '.m4a',
-                'image/webp': '.webp',
-            }
-            if mime in maps:
-                header_suffix = maps[mime]
-            # if 'application/octet-stream', just use the original suffix (guess_extension gives .bin)
-            elif mime == 'application/octet-stream':
-                header_suffix = ''
-            # only use guessed extension if it's valid (and not bin)
-            elif guess is not None:
-                header_suffix = guess
-            # last resort. NOTE: this does not work half the time, maybe just abandon it...
-            elif re.search(r'^[a-zA-Z0-9]+$', suffix_from_mime):
-                header_suffix = '.' + suffix_from_mime
-
-            # ignore invalid suffixes
-            if '-' in header_suffix or '+' in header_suffix:
-                header_suffix = ''
-            # early return if we have a valid suffix and it matches the file's suffix
-            if header_suffix:
-                if f.suffix.lower() == header_suffix:
+        # only use guessed extension if it's valid (and not bin)
+        elif guess is not None:
+            header_suffix = guess
+        # last resort. NOTE: this does not work half the time, maybe just abandon it...
+        elif re.search(r'^[a-zA-Z0-9]+$', suffix_from_mime):
+            header_suffix = '.' + suffix_from_mime
+
+        # ignore invalid suffixes
+        if '-' in header_suffix or '+' in header_suffix:
+            header_suffix = ''
+        # early return if we have a valid suffix and it matches the file's suffix
+        if header_suffix:
+            if f.suffix.lower() == header_suffix:
+                return f
+            # don't replace equivalent extensions
+            ext_alias_groups = [
+                ['.mp4', '.m4a', '.m4v', '.m4s'],
+                ['.jpg', '.jpeg'],
+                ['.m3u', '.m3u8'],
+                ['.mp2t', '.ts'],
+            ]
+            for aliases in ext_alias_groups:
+                if f.suffix.lower() in aliases and header_suffix in aliases:
                     return f
-                # don't replace equivalent extensions
-                ext_alias_groups = [
-                    ['.mp4', '.m4a', '.m4v', '.m4s'],
-                    ['.jpg', '.jpeg'],
-                    ['.m3u', '.m3u8'],
-                    ['.mp2t', '.ts'],
-                ]
-                for aliases in ext_alias_groups:
-                    if f.suffix.lower() in aliases and header_suffix in aliases:
-                        return f
-                # add it to candidate suffixes otherwise
-                header_suffixes.append(header_suffix)
-        # that means all the suffixes are invalid or empty; just return the original file
-        if not header_suffixes:
+            # add it to candidate suffixes otherwise
+            header_suffixes.append(header_suffix)
+    # that means all the suffixes are invalid or empty; just return the original file
+    if not header_suffixes:
+        return f
+    # use the first valid suffix from the header since we can't determine which one is the best.
+    # but print a warning if there are multiple valid suffixes.
+    if len(header_suffixes) > 1:
+        print(f'[Warning] Multiple valid suffixes found in Content-Type header: {header_suffixes}. Using the first one: {header_suffixes[0]}', 1)
+    header_suffix = header_suffixes[0]
+
+    # likely dynamic content, just use (add) header suffix silently
+    if f.suffix.lower() in ['.php', '.asp', '.jsp', '.cgi', '']:
+        return f.with_suffix(header_suffix)
+    # this is to prevent that when filename has dot in it, it would cause Path obj to consider part of stem is the suffix.
+    # so we only replace the suffix that is "valid" (<= 3 chars etc.) but wrong.
+    # Not ideal, but should be good enough.
+    if _has_valid_suffix(f):
+        print(f'[Warning] File suffix is different from the one in Content-Type header! {f.suffix.lower()} -> {header_suffix}', 1)
+        return f.with_suffix(header_suffix)
+    else:
+        # f has a weird suffix. We assume it's part of the name stem, so we just append the header suffix (silently).
+        return f.with_name(f.name + header_suffix)
+
+def _check_dupe(f, dupe, print, size=0):
+    if not f.exists():
+        return f
+    if dupe == 'skip_same_size':
+        if size:
+            # this part is basically `ensure_nonexist()` but the logic is slightly different:
+            # (if the filename exists and the filesize is the same, stop; otherwise find the next unoccupied filename.)
+            # Therefore, we have to repeat it here.
+            i = 2
+            stem = f.stem
+            if m := re.search(r'^(.+?)_(\d+)$', stem):
+                if int(m[2]) < 10 and len(m[2]) == 1:
+                    stem = m[1]
+                    i = int(m[2]) + 1
+            while f.exists():
+                existing_size = f.stat().st_size
+                if size == existing_size:
+                    print(f'[Warning] File {f.name} already exists and have same size! Skip download.', 1)
+                    return None
+                print(f'[Warning] File {f.name} already exists, and the size doesn\'t match (existing: {existing_size}; new: {size}). Rename..', 1)
+                f = f.with_name(f'{stem}_{i}{f.suffix}')
+                i = i + 1
             return f
-        # use the first valid suffix from the header since we can't determine which one is the best.
-        # but print a warning if there are multiple valid suffixes.
-        if len(header_suffixes) > 1:
-            print(f'[Warning] Multiple valid suffixes found in Content-Type header: {header_suffixes}. Using the first one: {header_suffixes[0]}', 1)
-        header_suffix = header_suffixes[0]
-
-        # likely dynamic content, just use (add) header suffix silently
-        if f.suffix.lower() in ['.php', '.asp', '.jsp', '.cgi', '']:
-            return f.with_suffix(header_suffix)
-        # this is to prevent that when filename has dot in it, it would cause Path obj to consider part of stem is the suffix.
-        # so we only replace the suffix that is "valid" (<= 3 chars etc.) but wrong.
-        # Not ideal, but should be good enough.
-        if has_valid_suffix(f):
-            print(f'[Warning] File suffix is different from the one in Content-Type header! {f.suffix.lower()} -> {header_suffix}', 1)
-            return f.with_suffix(header_suffix)
         else:
-            # f has a weird suffix. We assume it's part of the name stem, so we just append the header suffix (silently).
-            return f.with_name(f.name + header_suffix)
-
-    def check_dupe(f, dupe=dupe, size=0):
-        if not f.exists():
-            return f
-        if dupe == 'skip_same_size':
-            if size:
-                # this part is basically `ensure_nonexist()` but the logic is slightly different:
-                # (if the filename exists and the filesize is the same, stop; otherwise find the next unoccupied filename.)
-                # Therefore, we have to repeat it here.
-                i = 2
-                stem = f.stem
-                if m := re.search(r'^(.+?)_(\d+)$', stem):
-                    if int(m[2]) < 10 and len(m[2]) == 1:
-                        stem = m[1]
-                        i = int(m[2]) + 1
-                while f.exists():
-                    existing_size = f.stat().st_size
-                    if size == existing_size:
-                        print(f'[Warning] File {f.name} already exists and have same size! Skip download.', 1)
-                        return None
-                    print(f'[Warning] File {f.name} already exists, and the size doesn\'t match (existing: {existing_size}; new: {size}). Rename..', 1)
-                    f = f.with_name(f'{stem}_{i}{f.suffix}')
-                    i = i + 1
-                return f
-            else:
-                dupe = 'skip' # if we can't get size, just assume it's the same so we skip.
-        if dupe == 'overwrite':
-            print(f'[Warning] File {f.name} already exists! Overwriting...', 1)
-            return f
-        if dupe == 'skip':
-            print(f'[Warning] File {f.name} already exists! Skip.', 1)
-            return None
-        if dupe == 'rename':
-            f = ensure_nonexist(f)
-            print(f'[Warning] File already exists! Rename to {f.name}.', 1)
-            return f
-
-    if dry_run:
-        print(f'[Info only] URL: {url}', 1)
-        return 'Dry run'
-
-    if filename: # If filename is supplied
+            dupe = 'skip' # if we can't get size, just assume it's the same so we skip.
+    if dupe == 'overwrite':
+        print(f'[Warning] File {f.name} already exists! Overwriting...', 1)
+        return f
+    if dupe == 'skip':
+        print(f'[Warning] File {f.name} already exists! Skip.', 1)
+        return None
+    if dupe == 'rename':
+        f = ensure_nonexist(f)
+        print(f'[Warning] File already exists! Rename to {f.name}.', 1)
+        return f
+
+
+def _initial_filename(url, filename=None, save_path='.', prefix=''):
+    '''The target file before we get the response: either the given filename or save_path + web name.'''
+    if filename:
         f = Path(filename)
-        f = f.with_name(safeify(f.name))
-        # Check if file exists for dupe=skip and rename. Other dupe methods will check later.
-        if dupe in ['skip', 'rename']:
-            if not (f := check_dupe(f)):
-                return 'Exists'
-    else: # If not, create a f using save_path + web_name for now.
-        p = Path(save_path)
-        web_name = get_webname(url)
-        if prefix:
-            web_name = f'{prefix} ' + web_name
-        # a special case is when web_name is empty, which causes f to be just the save_path. We just don't check in this case.
-        if not web_name:
-            web_name = 'no_web_name'
-        f = p / safeify(web_name)
-        # Check if file exists for dupe=skip and rename. Other dupe methods will check later.
-        # Skip this check if filename is likely change by response header (by not having valid suffix)
-        # TODO: check if this is a good practice later.
-        if has_valid_suffix(f) and dupe in ['skip', 'rename']:
-            if not (f := check_dupe(f)):
-                return 'Exists'
-
-    # creating a new session is extremely expansive, so only do so
-    # if the user does not supply a session.
-    if not session:
-        session = requests_retry_session()
-    if headers:
-        session.headers.update(headers)
-    if referer:
-        session.headers.update({'referer': referer})
-    if cookies:
-        session.cookies.update(cookies)
-
-    f.parent.mkdir(parents=True, exist_ok=True)
-
-    r = session.get(url, stream=True)
-    if not r.status_code == 200:
-        r.close()
-        print(f'[Error] Get HTTP {r.status_code} from {url}.', 0)
-        if placeholder:
-            broken_file = f.with_name(f.name + '.broken')
-            broken_file = ensure_nonexist(broken_file)
-            broken_file.touch()
-        return r.status_code
-
+        return f.with_name(safeify(f.name))
+    web_name = get_webname(url)
+    if prefix:
+        web_name = f'{prefix} ' + web_name
+    # a special case is when web_name is empty, which causes f to be just the save_path. We just don't check in this case.
+    if not web_name:
+        web_name = 'no_web_name'
+    return Path(save_path) / safeify(web_name)
+
+def _filename_from_response(f, url, final_url, headers, print, filename=None, save_path='.', prefix='', get_suffix=True):
+    '''Update the target file using the response (redirected URL, Content-Disposition and Content-Type).'''
+    p = Path(save_path)
     if not filename: # Try to find filename using the response again, if not specified
-        if r.url != url: # Get filename again from URL for potential 302/301
-            web_name = get_webname(r.url)
+        if final_url != url: # Get filename again from URL for potential 302/301
+            web_name = get_webname(final_url)
             if prefix:
                 web_name = f'{prefix} ' + web_name
             f = p / safeify(web_name)
-        if "Content-Disposition" in r.headers: # Get filename from the header
+        if "Content-Disposition" in headers: # Get filename from the header
             # Content-Disposition can have multiple formats, e.g.:
 
             # Content-Disposition: inline
@@ -1166,7 +2451,7 @@ def download(url, filename=None, save_path='.', cookies=None, session=None, dry_
             # Content-Disposition: attachment; filename="file name.jpg"
             # Content-Disposition: attachment; filename*=UTF-8''file%20name.jpg
             # Content-Disposition: filename="file name.jpg" # non-standard, but some sites do this.
-            content_disposition = r.headers["Content-Disposition"]
+            content_disposition = headers["Content-Disposition"]
             # parse it to get params
             header_name = ''
             if m := re.search(r'filename="(.+)"', content_disposition):
@@ -1178,64 +2463,556 @@ def download(url, filename=None, save_path='.', cookies=None, session=None, dry_
                     header_name = f'{prefix} ' + header_name
                 f = p / safeify(header_name)
 
-    if (get_suffix or not has_valid_suffix(f)) and 'Content-Type' in r.headers: # Also find the file extension
-        f = replace_suffix(f, r.headers['Content-Type'])
+    if (get_suffix or not _has_valid_suffix(f)) and 'Content-Type' in headers: # Also find the file extension
+        f = _replace_suffix(f, headers['Content-Type'], print)
+    return f
 
-    expected_size = int(r.headers.get('Content-length', 0))
+def _expected_size(headers, print):
+    expected_size = int(headers.get('Content-length', 0))
     if expected_size == 0:
         print('[Warning] Cannot get Content-Length. Omit size check', 2)
-    elif r.headers.get('content-encoding', None): # Ignore content-length if it's compressed.
+    elif headers.get('content-encoding', None): # Ignore content-length if it's compressed.
         print('[Warning] Content is compressed. Omit size check.', 2)
         expected_size = 0
+    return expected_size
+
+_stream_buffers = threading.local()
+
+def write_stream(response, fio, limiter=None, hasher=None, min_chunk_size=64*1024, max_chunk_size=4*1024*1024):
+    '''
+    Write the body of a streaming requests response into the file object fio.
 
-    # Check it again before download starts.
-    # NOTE: if dupe=overwrite, it will check (and print) twice, before and after downloading. This is by design.
-    if not (f := check_dupe(f, size=expected_size)):
+    If the body isn't compressed, it is read with readinto() into a reusable per-thread buffer (grown as needed, up to
+    max_chunk_size) instead of creating a bytes object per 8KB chunk. The read size adapts between min_chunk_size and max_chunk_size: it doubles
+    while reads are fast and halves when a read takes long, so slow links still report/throttle in time.
+    Compressed bodies go through iter_content() (which decodes them) with large chunks.
+
+    Args:
+        response (requests.Response): The response, requested with stream=True.
+        fio (file object): The file to write into (at its current position).
+        limiter (HostLimiter, optional): Throttle the bytes/sec with it. Defaults to None.
+        hasher (optional): A hasher from new_hasher(), updated with the data as it is written. Defaults to None.
+
+    Returns:
+        tuple: (bytes written, seconds spent), which are also recorded in `metrics`.
+    '''
+    start = time.perf_counter()
+    written = 0
+    if response.headers.get('Content-Encoding') or not hasattr(response.raw, 'readinto'):
+        for chunk in response.iter_content(chunk_size=1024*1024):
+            if chunk:
+                fio.write(chunk)
+                written += len(chunk)
+                if hasher:
+                    hasher.update(chunk)
+                if limiter:
+                    limiter.throttle(len(chunk))
+        seconds = time.perf_counter() - start
+        metrics.record_transfer(response.url, written, seconds)
+        return written, seconds
+
+    buffer = getattr(_stream_buffers, 'buffer', None)
+    chunk_size = min_chunk_size
+    view = None
+    while True:
+        # the buffer only grows as far as the chunk size actually gets, so threads downloading small files keep a small one.
+        if buffer is None or len(buffer) < chunk_size:
+            view = None
+            buffer = _stream_buffers.buffer = bytearray(chunk_size)
+        if view is None:
+            view = memoryview(buffer)
+        t = time.perf_counter()
+        n = response.raw.readinto(view[:chunk_size])
+        if not n:
+            break
+        fio.write(view[:n])
+        written += n
+        if hasher:
+            hasher.update(view[:n])
+        if limiter:
+            limiter.throttle(n)
+        elapsed = time.perf_counter() - t
+        if elapsed < 0.05 and chunk_size < max_chunk_size:
+            chunk_size *= 2
+        elif elapsed > 1 and chunk_size > min_chunk_size:
+            chunk_size //= 2
+    seconds = time.perf_counter() - start
+    metrics.record_transfer(response.url, written, seconds)
+    return written, seconds
+
+def format_speed(size, seconds):
+    '''Format a throughput, e.g. format_speed(10485760, 2) -> '5.00 MB/s'.'''
+    speed = size / seconds if seconds > 0 else 0
+    for unit in ['B', 'KB', 'MB']:
+        if speed < 1024:
+            return f'{speed:.2f} {unit}/s'
+        speed /= 1024
+    return f'{speed:.2f} GB/s'
+
+def _finish_download(temp_file, f, url, size, digest=None, index=None, store=None):
+    '''
+    Move the finished temp_file to f (through the blob store, if given), and record it in the index.
+    Without index (and store), the hash ("{algo}:{hexdigest}") is saved in a "{name}.{algo}" file next to it.
+    '''
+    if f.exists(): # this means overwrite. So remove before rename.
+        f.unlink()
+    if store is not None:
+        store.add(temp_file, digest, f)
+    else:
+        temp_file.rename(f)
+    if index is not None:
+        index.add(url, f, size=size, hash=digest)
+    elif digest and store is None:
+        algo, hexdigest = digest.split(':', 1)
+        f.with_name(f'{f.name}.{algo}').write_text(f'{hexdigest} *{f.name}\n', encoding='utf-8')
+
+def _link_from_store(record, filename, store, print):
+    '''
+    For a URL already in the index: if it's wanted at a new filename (e.g. a different template) and the store has its content,
+    link it there without downloading. Returns whether it's linked.
+    '''
+    if store is None or not filename or record['hash'] not in store:
+        return False
+    f = Path(filename)
+    f = f.with_name(safeify(f.name))
+    if f.exists():
+        return False
+    store.link(record['hash'], f)
+    print(f'[Info] {f.name} is linked from the store (already downloaded as {record["path"]}).', 1)
+    return True
+
+RANGE_CHUNK_SIZE = 16 * 1024 * 1024 # 16MB per HTTP Range request when using multiple connections
+
+def _ranged_download(session, url, temp_file, size, connections=4, headers=None, cookies=None, print=None, validator=None):
+    '''
+    Download `url` into `temp_file` using parallel HTTP Range requests of RANGE_CHUNK_SIZE each.
+    Finished chunks are recorded in a "{temp_file}.parts" file, so calling it again on the same
+    temp_file (e.g. after a flaky connection or in a new run) only fetches the missing chunks.
+
+    validator (the strong ETag or Last-Modified of the file) is recorded in the .parts file too, and sent as If-Range,
+    so chunks of a different version of the file (even with the same size) are never stitched together:
+    if it doesn't match, it starts over.
+
+    Returns:
+        bool: whether all the chunks are downloaded.
+    '''
+    import concurrent.futures
+
+    if print is None:
+        print = lambda s, verbose_level=0: builtins.print(s)
+    parts_file = temp_file.with_name(temp_file.name + '.parts')
+    chunks = [(start, min(start + RANGE_CHUNK_SIZE, size) - 1) for start in range(0, size, RANGE_CHUNK_SIZE)]
+    done = set()
+    if temp_file.exists() and parts_file.exists() and temp_file.stat().st_size == size:
+        # the first line is "# {validator}" (or just "#" if there is none)
+        lines = parts_file.read_text().splitlines()
+        saved_validator = lines[0][1:].strip() if lines and lines[0].startswith('#') else ''
+        if saved_validator == (validator or ''):
+            done = {int(x) for x in lines if x.strip() and not x.startswith('#')}
+        else:
+            print(f'[Warning] {url} has changed since the last (unfinished) download of {temp_file.name}. Start over.', 1)
+    if not done:
+        # preallocate so each chunk can be written at its own offset
+        with temp_file.open('wb') as fio:
+            fio.truncate(size)
+        parts_file.write_text(f'# {validator or ""}\n')
+    todo = [idx for idx in range(len(chunks)) if idx not in done]
+    if done:
+        print(f'[Info] Resume {temp_file.name}: {len(done)}/{len(chunks)} chunks already downloaded.', 1)
+    lock = threading.Lock()
+    changed = threading.Event()
+
+    limiter = host_limiter(url)
+    range_headers = {**(headers or {}), 'If-Range': validator} if validator else {**(headers or {})}
+
+    def fetch(idx):
+        start, end = chunks[idx]
+        if changed.is_set():
+            return False
+        try:
+            with limiter.slot(), session.get(url, stream=True, headers={**range_headers, 'Range': f'bytes={start}-{end}'}, cookies=cookies) as r:
+                if r.status_code == 200 and validator:
+                    # If-Range didn't match: the file has changed on the server.
+                    changed.set()
+                    print(f'[Warning] {url} has changed on the server during the download. Start over.', 1)
+                    return False
+                if r.status_code != 206:
+                    print(f'[Warning] Get HTTP {r.status_code} for range {start}-{end} of {url}.', 1)
+                    return False
+                with temp_file.open('r+b') as fio:
+                    fio.seek(start)
+                    written, _ = write_stream(r, fio, limiter=limiter)
+        except Exception as e:
+            print(f'[Warning] Failed to get range {start}-{end} of {url}: {e}', 1)
+            return False
+        if written != end - start + 1:
+            print(f'[Warning] Range {start}-{end} is incomplete ({written} bytes).', 1)
+            return False
+        with lock:
+            with parts_file.open('a') as pf:
+                pf.write(f'{idx}\n')
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=connections) as ex:
+        results = list(ex.map(fetch, todo))
+    if changed.is_set():
+        # the chunks we have are of the old version; the next call starts over.
+        parts_file.unlink(missing_ok=True)
+    return all(results)
+
+def download(url, filename=None, save_path='.', cookies=None, session=None, dry_run=False,
+             dupe='skip_same_size', referer=None, headers=None, placeholder=True, prefix='',
+             get_suffix=True, verbose=2, retry_failed=True, connections=1, index=None, hash_algo=None, store=None):
+    """
+    Downloads a file from the given URL and saves it to the specified location.
+
+    Args:
+        url (str): The URL of the file to download.
+        filename (str, optional): The name of the file to save. If not provided, the filename will be extracted from the URL or the response header. Defaults to None.
+        save_path (str, optional): The directory path to save the file. Defaults to '.' (current directory).
+        cookies (dict, optional): A dictionary of cookies to include in the request. Defaults to None.
+        session (requests.Session, optional): A requests Session object to use for the request. Defaults to None (use the shared one from get_session()).
+        dry_run (bool, optional): If True, only prints the URL and does not perform the actual download. Defaults to False.
+        dupe (str, optional): The method to handle duplicate files. Must be one of 'skip', 'overwrite', 'rename', or 'skip_same_size'. Defaults to 'skip_same_size'.
+        referer (str, optional): The referer header to include in the request. Defaults to None.
+        headers (dict, optional): Additional headers to include in the request. Defaults to None.
+        placeholder (bool, optional): If True, creates a placeholder file with a '.broken' extension if the download fails. Defaults to True.
+        prefix (str, optional): A prefix to add to the filename. Useful when fetching the filename from the response headers. Defaults to ''.
+        get_suffix (bool, optional): If True, attempts to determine the file extension from the response headers. Defaults to True.
+        verbose (int, optional): The verbosity level of the download progress. Must be 0, 1, or 2. Defaults to 2.
+        retry_failed (bool, optional): If True, retries the download if it fails. Defaults to True.
+        connections (int, optional): The number of parallel HTTP Range connections to use for files larger than RANGE_CHUNK_SIZE,
+            if the server supports it. Unfinished downloads are resumed from the existing .dl file. Defaults to 1 (single stream).
+        index (DownloadIndex, optional): If given, skip URLs that are already in the index, and record finished downloads in it.
+            Ignored for the skip check if dupe is 'overwrite'. Defaults to None.
+        hash_algo (str, optional): If given (e.g. 'blake2b', 'sha256' or 'xxh3_128', see new_hasher()), compute the full-content hash
+            while downloading, and store it in the index, or in a "{filename}.{hash_algo}" file next to it without index. Defaults to None.
+        store (BlobStore, optional): If given, keep the content in the store (only once for the same content) and hardlink it to the file.
+            If the URL is in the index with a hash the store has, the file is linked from the store without downloading. Defaults to None.
+
+    Returns:
+        str: The status of the download. Can be 'Dry run', 'Exists', or the HTTP status code.
+    """
+    # it uses requests_retry_session, so
+    # pip install requests
+
+    if dupe not in ['skip', 'overwrite', 'rename', 'skip_same_size']:
+        raise ValueError(f'[Error] Invalid dupe method: {dupe} (must be either skip, overwrite, rename or skip_same_size).')
+
+    print = _make_print(verbose)
+    has_valid_suffix = _has_valid_suffix
+
+    def check_dupe(f, dupe=dupe, size=0):
+        return _check_dupe(f, dupe, print, size=size)
+
+    if dry_run:
+        print(f'[Info only] URL: {url}', 1)
+        return 'Dry run'
+
+    if store is not None:
+        hash_algo = hash_algo or store.algo
+        if hash_algo != store.algo:
+            raise ValueError(f'[Error] hash_algo ({hash_algo}) must be the same as the store ({store.algo}).')
+
+    if index is not None and dupe != 'overwrite' and (record := index.get(url)):
+        if _link_from_store(record, filename, store, print):
+            return 'Exists'
+        print(f'[Warning] {url} is already downloaded to {record["path"]} (according to the index). Skip.', 1)
         return 'Exists'
-    print(f'Downloading {f.name} from {url}...', 2)
-    print(f'Downloading {f.name}...', 1, only=True)
-    temp_file = f.with_name(f.name + '.dl')
-    temp_file = ensure_nonexist(temp_file)
-    broken_file = f.with_name(f.name + '.broken')
-    broken_file = ensure_nonexist(broken_file)
-
-    def actually_download(file, response):
-        with file.open('wb') as fio:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    fio.write(chunk)
-
-    actually_download(temp_file, r)
-    r.close()
-
-    downloaded_size = temp_file.stat().st_size
-    #TODO: maybe we should just retry the whole thing. And capture any exceptions too.
-    if expected_size and downloaded_size != expected_size and retry_failed:
-        retries = 1
-        while retries < 5:
-            print(f'[Warning] file size does not match (expected: {expected_size}, actual: {downloaded_size}). Retry {retries}', 1)
-            with session.get(url, stream=True) as r2:
-                actually_download(temp_file, r2)
-            downloaded_size = temp_file.stat().st_size
-            if downloaded_size == expected_size:
-                break
-            retries += 1
 
-    if expected_size and downloaded_size != expected_size:
-        print(f'[Error] file size does not match (expected: {expected_size}, actual: {downloaded_size}). Please check!', 0)
-        temp_file.rename(broken_file)
+    f = _initial_filename(url, filename, save_path, prefix)
+    # Check if file exists for dupe=skip and rename. Other dupe methods will check later.
+    # If filename is not supplied, skip this check if filename is likely change by response header (by not having valid suffix)
+    # TODO: check if this is a good practice later.
+    if (filename or has_valid_suffix(f)) and dupe in ['skip', 'rename']:
+        if not (f := check_dupe(f)):
+            return 'Exists'
+
+    # creating a new session is extremely expansive, so use the shared one
+    # if the user does not supply a session.
+    if not session:
+        session = get_session()
+    # headers and cookies are sent per request, so the (maybe shared) session is not modified.
+    headers = dict(headers or {})
+    if referer:
+        headers['referer'] = referer
+
+    f.parent.mkdir(parents=True, exist_ok=True)
+
+    # hold a connection slot of the host (see set_host_limit()) while downloading.
+    limiter = host_limiter(url)
+    with limiter.slot() as slot:
+        r = session.get(url, stream=True, headers=headers, cookies=cookies)
+        if not r.status_code == 200:
+            r.close()
+            print(f'[Error] Get HTTP {r.status_code} from {url}.', 0)
+            if placeholder:
+                broken_file = f.with_name(f.name + '.broken')
+                broken_file = ensure_nonexist(broken_file)
+                broken_file.touch()
+            return r.status_code
+
+        f = _filename_from_response(f, url, r.url, r.headers, print, filename=filename, save_path=save_path, prefix=prefix, get_suffix=get_suffix)
+        expected_size = _expected_size(r.headers, print)
+
+        # Check it again before download starts.
+        # NOTE: if dupe=overwrite, it will check (and print) twice, before and after downloading. This is by design.
+        if not (f := check_dupe(f, size=expected_size)):
+            return 'Exists'
+        print(f'Downloading {f.name} from {url}...', 2)
+        print(f'Downloading {f.name}...', 1, only=True)
+        accept_ranges = expected_size and r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        ranged = connections > 1 and accept_ranges and expected_size > RANGE_CHUNK_SIZE
+        temp_file = f.with_name(f.name + '.dl')
+        # a leftover .dl with a .parts file is an unfinished ranged download (of ours). Resume it instead of starting over.
+        if not (ranged and temp_file.with_name(temp_file.name + '.parts').exists()):
+            temp_file = ensure_nonexist(temp_file)
+        broken_file = f.with_name(f.name + '.broken')
+        broken_file = ensure_nonexist(broken_file)
+
+        download_start = time.perf_counter()
+        # the hash is computed while streaming. If the data isn't written in one go (ranged, resumed or retried),
+        # it is computed from the file at the end instead.
+        hasher = new_hasher(hash_algo) if hash_algo else None
+
+        def actually_download(file, response, mode='wb', hasher=None):
+            # exceptions in the middle of streaming (dropped connection etc.) are not fatal;
+            # the size check below will pick it up and retry/resume.
+            try:
+                with file.open(mode) as fio:
+                    write_stream(response, fio, limiter=limiter, hasher=hasher)
+            except Exception as e:
+                print(f'[Warning] Download of {file.name} is interrupted: {e}', 1)
+
+        if ranged:
+            r.close()
+            # each chunk takes its own connection slot.
+            slot.release()
+            print(f'[Info] Use {connections} connections to download {f.name} ({expected_size} bytes).', 2)
+            # use the final URL so redirects (e.g. to signed CDN URLs) don't have to be followed for each chunk.
+            range_url = r.url
+            # a weak ETag can't be used for If-Range.
+            etag = r.headers.get('ETag')
+            validator = etag if etag and not etag.startswith('W/') else r.headers.get('Last-Modified')
+            completed = _ranged_download(session, range_url, temp_file, expected_size, connections, headers=headers, cookies=cookies, print=print, validator=validator)
+            retries = 1
+            while not completed and retry_failed and retries < 5:
+                print(f'[Warning] some chunks of {f.name} failed. Retry {retries}', 1)
+                completed = _ranged_download(session, range_url, temp_file, expected_size, connections, headers=headers, cookies=cookies, print=print, validator=validator)
+                retries += 1
+            if not completed:
+                # keep the .dl and .parts file, so the next run can resume from here.
+                print(f'[Error] failed to download all the chunks of {f.name}. Run again to resume.', 0)
+                return r.status_code
+            temp_file.with_name(temp_file.name + '.parts').unlink()
+            hasher = None
+        else:
+            actually_download(temp_file, r, hasher=hasher)
+            r.close()
+
+        downloaded_size = temp_file.stat().st_size
+        if expected_size and downloaded_size != expected_size and retry_failed:
+            hasher = None
+            retries = 1
+            while retries < 5:
+                print(f'[Warning] file size does not match (expected: {expected_size}, actual: {downloaded_size}). Retry {retries}', 1)
+                try:
+                    # resume from what we already have if the server supports it; otherwise start over.
+                    if accept_ranges and 0 < downloaded_size < expected_size:
+                        with session.get(url, stream=True, headers={**headers, 'Range': f'bytes={downloaded_size}-'}, cookies=cookies) as r2:
+                            # 200 means the server sent the whole file instead; anything else is an error (don't write its body).
+                            if r2.status_code in [200, 206]:
+                                actually_download(temp_file, r2, mode='ab' if r2.status_code == 206 else 'wb')
+                            else:
+                                print(f'[Warning] Get HTTP {r2.status_code} when resuming {f.name}.', 1)
+                    else:
+                        with session.get(url, stream=True, headers=headers, cookies=cookies) as r2:
+                            if r2.status_code == 200:
+                                actually_download(temp_file, r2)
+                            else:
+                                print(f'[Warning] Get HTTP {r2.status_code} when retrying {f.name}.', 1)
+                except Exception as e:
+                    print(f'[Warning] Retry {retries} failed: {e}', 1)
+                downloaded_size = temp_file.stat().st_size
+                if downloaded_size == expected_size:
+                    break
+                retries += 1
+
+        if expected_size and downloaded_size != expected_size:
+            print(f'[Error] file size does not match (expected: {expected_size}, actual: {downloaded_size}). Please check!', 0)
+            temp_file.rename(broken_file)
+            return r.status_code
+
+        # post-processing
+        f = check_dupe(f, size=downloaded_size) # Check again. Because some other programs may create the file during downloading
+        if not f: # this means skip. Remove what we just downloaded.
+            temp_file.unlink()
+            return 'Exists'
+        # In other case, either f has been renamed or no conflict (or overwrite). So just rename.
+        digest = None
+        if hash_algo:
+            digest = f'{hash_algo}:{hasher.hexdigest()}' if hasher else hash_file(temp_file, hash_algo)
+        _finish_download(temp_file, f, url, downloaded_size, digest=digest, index=index, store=store)
+        print(f'Downloaded {f.name} ({downloaded_size} bytes, {format_speed(downloaded_size, time.perf_counter() - download_start)}).', 2)
         return r.status_code
 
-    # post-processing
-    f = check_dupe(f, size=downloaded_size) # Check again. Because some other programs may create the file during downloading
-    if not f: # this means skip. Remove what we just downloaded.
-        temp_file.unlink()
+async def download_async(session, url, filename=None, save_path='.', dupe='skip_same_size', headers=None,
+                         placeholder=True, prefix='', get_suffix=True, verbose=2, retry_failed=True, index=None, hash_algo=None, store=None):
+    """
+    The asyncio version of download(), using an aiohttp.ClientSession instead of requests.
+    Filename, dupe and suffix handling is the same as download(). See download_batch() for the usual entry point.
+
+    Args:
+        session (aiohttp.ClientSession): The session to use. It is shared by all the downloads.
+        Others: see download().
+
+    Returns:
+        str: The status of the download. Can be 'Exists', or the HTTP status code.
+    """
+    # pip install aiohttp
+    import asyncio
+    import aiohttp
+
+    if dupe not in ['skip', 'overwrite', 'rename', 'skip_same_size']:
+        raise ValueError(f'[Error] Invalid dupe method: {dupe} (must be either skip, overwrite, rename or skip_same_size).')
+
+    print = _make_print(verbose)
+
+    if store is not None:
+        hash_algo = hash_algo or store.algo
+        if hash_algo != store.algo:
+            raise ValueError(f'[Error] hash_algo ({hash_algo}) must be the same as the store ({store.algo}).')
+
+    if index is not None and dupe != 'overwrite' and (record := index.get(url)):
+        if _link_from_store(record, filename, store, print):
+            return 'Exists'
+        print(f'[Warning] {url} is already downloaded to {record["path"]} (according to the index). Skip.', 1)
         return 'Exists'
-    if f.exists(): # this means overwrite. So remove before rename.
-        f.unlink()
-    # In other case, either f has been renamed or no conflict. So just rename.
-    temp_file.rename(f)
-    return r.status_code
+
+    initial_f = _initial_filename(url, filename, save_path, prefix)
+    if (filename or _has_valid_suffix(initial_f)) and dupe in ['skip', 'rename']:
+        if not (initial_f := _check_dupe(initial_f, dupe, print)):
+            return 'Exists'
+    initial_f.parent.mkdir(parents=True, exist_ok=True)
+
+    # same as the defaults of requests_retry_session().
+    attempts = 5
+    backoff_factor = 0.2
+    last_error = None
+    limiter = host_limiter(url)
+    for attempt in range(attempts):
+        if attempt:
+            await asyncio.sleep(backoff_factor * 2 ** attempt)
+        temp_file = None
+        # hold a connection slot of the host (see set_host_limit()) while downloading.
+        slot = await limiter.aslot_acquire()
+        try:
+            t = time.perf_counter()
+            try:
+                r = await session.get(url, headers=headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                metrics.record_error(url)
+                raise
+            async with r:
+                status = r.status
+                metrics.record_response(url, status, time.perf_counter() - t)
+                if status in (502, 503, 504) and attempt < attempts - 1:
+                    metrics.record_retry(url, backoff_factor * 2 ** (attempt + 1))
+                    continue
+                if status != 200:
+                    print(f'[Error] Get HTTP {status} from {url}.', 0)
+                    if placeholder:
+                        broken_file = initial_f.with_name(initial_f.name + '.broken')
+                        ensure_nonexist(broken_file).touch()
+                    return status
+
+                f = _filename_from_response(initial_f, url, str(r.url), r.headers, print, filename=filename, save_path=save_path, prefix=prefix, get_suffix=get_suffix)
+                expected_size = _expected_size(r.headers, print)
+                if not (f := _check_dupe(f, dupe, print, size=expected_size)):
+                    return 'Exists'
+                print(f'Downloading {f.name} from {url}...', 2)
+                print(f'Downloading {f.name}...', 1, only=True)
+                # no await between ensure_nonexist() and open(), so other tasks can't take the same name.
+                temp_file = ensure_nonexist(f.with_name(f.name + '.dl'))
+                hasher = new_hasher(hash_algo) if hash_algo else None
+                t = time.perf_counter()
+                with temp_file.open('wb') as fio:
+                    async for chunk in r.content.iter_chunked(256*1024):
+                        fio.write(chunk)
+                        if hasher:
+                            hasher.update(chunk)
+                        await limiter.athrottle(len(chunk))
+                    metrics.record_transfer(url, fio.tell(), time.perf_counter() - t)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f'[Warning] Failed to download {url}: {e!r}. Retry {attempt + 1}', 1)
+            metrics.record_retry(url, backoff_factor * 2 ** (attempt + 1))
+            last_error = e
+            if temp_file and temp_file.exists():
+                temp_file.unlink()
+            continue
+        finally:
+            slot.release()
+
+        downloaded_size = temp_file.stat().st_size
+        if expected_size and downloaded_size != expected_size:
+            if retry_failed and attempt < attempts - 1:
+                print(f'[Warning] file size does not match (expected: {expected_size}, actual: {downloaded_size}). Retry {attempt + 1}', 1)
+                metrics.record_retry(url, backoff_factor * 2 ** (attempt + 1))
+                temp_file.unlink()
+                continue
+            print(f'[Error] file size does not match (expected: {expected_size}, actual: {downloaded_size}). Please check!', 0)
+            temp_file.rename(ensure_nonexist(f.with_name(f.name + '.broken')))
+            return status
+
+        # post-processing
+        f = _check_dupe(f, dupe, print, size=downloaded_size) # Check again. Because other tasks may create the file during downloading
+        if not f:
+            temp_file.unlink()
+            return 'Exists'
+        digest = f'{hash_algo}:{hasher.hexdigest()}' if hasher else None
+        _finish_download(temp_file, f, url, downloaded_size, digest=digest, index=index, store=store)
+        return status
+    raise last_error
+
+def download_batch(jobs, save_path='.', max_concurrency=100, limit_per_host=0, headers=None, cookies=None, referer=None, **kwargs):
+    """
+    Download a lot of (small) files concurrently in one thread with asyncio, sharing a single connection pool.
+    Use it instead of wrapping download() in a ThreadPoolExecutor.
+
+    Args:
+        jobs (list): A list of (url, filename) tuples. filename can be None to use save_path + the name from URL/response, like download().
+        save_path (str, optional): The directory path to save the files without filename. Defaults to '.' (current directory).
+        max_concurrency (int, optional): The maximum number of connections in flight. Defaults to 100.
+        limit_per_host (int, optional): The maximum number of connections to the same host. Defaults to 0 (no limit).
+        headers (dict, optional): Headers to include in all the requests. Defaults to None.
+        cookies (dict, optional): Cookies to include in all the requests. Defaults to None.
+        referer (str, optional): The referer header to include in all the requests. Defaults to None.
+        **kwargs: Other arguments passed to download_async() (dupe, placeholder, prefix, get_suffix, verbose, retry_failed, index, hash_algo, store).
+
+    Returns:
+        list: The status of each job, in the same order as `jobs`. If a job failed with an exception, the exception is returned instead.
+    """
+    # pip install aiohttp
+    import asyncio
+    import aiohttp
+
+    headers = dict(headers or {})
+    if referer:
+        headers['referer'] = referer
+
+    async def main():
+        connector = aiohttp.TCPConnector(limit=max_concurrency, limit_per_host=limit_per_host)
+        # no total timeout since large files can take forever; only give up if the connection stalls.
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=headers, cookies=cookies) as session:
+            tasks = [download_async(session, url, filename, save_path=save_path, **kwargs) for url, filename in jobs]
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = asyncio.run(main())
+    for (url, _), result in zip(jobs, results):
+        if isinstance(result, Exception):
+            builtins.print(f'[Error] Failed to download {url}: {result!r}')
+    return results
 
 def sheet_api():
     """Shows basic usage of the Sheets API.
@@ -1282,7 +3059,16 @@ def hello(a, b):
     print(f'hello: {a} and {b}')
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 1 and sys.argv[1] == 'dedupe':
+        import argparse
+        parser = argparse.ArgumentParser(prog='util.py dedupe', description='Find (and remove) duplicate files.')
+        parser.add_argument('directories', nargs='+', help='folder(s) to scan (recursively)')
+        parser.add_argument('--action', default='print', choices=['print', 'delete', 'link'], help='what to do with the duplicates (default: print)')
+        parser.add_argument('--cache', help='SQLite file to cache hashes in, so re-scans only hash changed files')
+        parser.add_argument('--workers', type=int, default=8, help='number of hashing threads (default: 8)')
+        args = parser.parse_args(sys.argv[2:])
+        dedupe(args.directories, action=args.action, cache=args.cache, workers=args.workers)
+    elif len(sys.argv) > 1:
         download(*sys.argv[1:])
     else:
         print('util.py installed correctly.')